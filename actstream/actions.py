@@ -1,11 +1,17 @@
 import datetime
+import operator
 
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
-from itertools import chain
+from collections import defaultdict
+from itertools import chain, islice
 
 from actstream.exceptions import check_actionable_model
-from actstream import settings
+from actstream import batching, fanout, feed_plan, follow_cache, ingestion,\
+    pubsub, settings, stream_cache, watermark
 from django.conf import settings as _settings
 try:
     from django.utils import timezone
@@ -44,6 +50,12 @@ def follow(user, obj, send_action=True, actor_only=True):
         actor_only=actor_only,
         site_id=_settings.SITE_ID,
     )
+    if created:
+        follow_cache.invalidate(user)
+        feed_plan.invalidate(user)
+        _count_follows(user, [(follow.content_type_id, follow.object_id)], 1)
+    if created and fanout.is_enabled('user'):
+        fanout.backfill_follow(follow)
     if send_action and created:
         action.send(
             user,
@@ -52,17 +64,9 @@ def follow(user, obj, send_action=True, actor_only=True):
             batch_time_minutes=30,
             is_batchable=True
         )
-        recipients = [obj]
-        if obj.__class__.__name__ == 'Company':
-            admins = obj.admins.all()
-            recipients = set(chain(
-                [obj.admin_primary] if obj.admin_primary and not obj.admin_primary.is_staff else [],
-                admins
-            ))
-
-        if not obj.__class__.__name__ == 'Post':
+        if _notifies_follow(obj):
             task_notice.delay(
-                recipients,
+                _follow_recipients(obj),
                 "follower",
                 {'target': obj},
                 sender=user
@@ -85,12 +89,207 @@ def unfollow(user, obj, send_action=False):
     from actstream.models import Follow, action
 
     check_actionable_model(obj)
-    Follow.objects.filter(user=user, object_id=obj.pk,
-        content_type=ContentType.objects.get_for_model(obj)).delete()
+    follows = Follow.objects.filter(user=user, object_id=obj.pk,
+        content_type=ContentType.objects.get_for_model(obj))
+    counted = list(follows.filter(site=_settings.SITE_ID).values_list(
+        'content_type_id', 'object_id'))
+    follows.delete()
+    follow_cache.invalidate(user)
+    feed_plan.invalidate(user)
+    _count_follows(user, counted, -1)
+    if fanout.is_enabled('user'):
+        fanout.prune_unfollow(user, obj)
     if send_action:
         action.send(user, verb=_settings.UNFOLLOW_VERB, target=obj)
 
 
+def _count_follows(user, follows, delta):
+    """
+    Adds ``delta`` to the follower counts of the ``(content_type_id,
+    object_id)`` pairs of ``follows`` and ``delta`` per follow to the
+    following count of ``user``.
+    """
+    from actstream.models import FollowCount
+
+    if not follows:
+        return
+    ids_by_content_type = defaultdict(list)
+    for content_type_id, object_id in follows:
+        ids_by_content_type[content_type_id].append(object_id)
+    for content_type_id, object_ids in ids_by_content_type.items():
+        FollowCount.objects.adjust(content_type_id, object_ids,
+                                   'followers_count', delta)
+    FollowCount.objects.adjust(ContentType.objects.get_for_model(user).pk,
+                               [user.pk], 'following_count',
+                               delta * len(follows))
+
+
+def _follow_recipients(obj):
+    """
+    Returns who is notified when ``obj`` gets a new follower.
+    """
+    recipients = [obj]
+    if obj.__class__.__name__ == 'Company':
+        admins = obj.admins.all()
+        recipients = set(chain(
+            [obj.admin_primary] if obj.admin_primary and not obj.admin_primary.is_staff else [],
+            admins
+        ))
+    return recipients
+
+
+def _notifies_follow(obj):
+    return not obj.__class__.__name__ == 'Post'
+
+
+def _objects_q(objects, prefix=''):
+    """
+    Returns a Q matching the given objects by content type and object id,
+    with one ``object_id__in`` clause per content type.
+    """
+    ids_by_content_type = defaultdict(list)
+    for obj in objects:
+        ids_by_content_type[ContentType.objects.get_for_model(obj)].append(
+            smart_unicode(obj.pk))
+    return reduce(operator.or_, [
+        Q(**{'%scontent_type' % prefix: content_type,
+             '%sobject_id__in' % prefix: object_ids})
+        for content_type, object_ids in ids_by_content_type.items()])
+
+
+def follow_many(user, objects, send_action=True, actor_only=True):
+    """
+    Follows many objects at once, like calling ``follow`` for each of them.
+
+    The existing follows are looked up with one query, the missing ones are
+    inserted with ``bulk_create`` (one by one if some of them are created
+    concurrently), their follow actions are written with
+    ``bulk_action`` and the notifications are enqueued as one group of tasks.
+
+    Returns the list of created ``Follow`` instances.
+
+    Example::
+
+        follow_many(request.user, suggested_users)
+    """
+    from actstream.models import Follow
+    from people.tasks import task_notice
+    from celery import group
+
+    objects = dict(((obj.__class__, smart_unicode(obj.pk)), obj)
+                   for obj in objects)
+    for model in set(model for model, pk in objects):
+        check_actionable_model(model)
+    if not objects:
+        return []
+
+    existing = set(Follow.objects.filter(_objects_q(objects.values()),
+        user=user).values_list('content_type_id', 'object_id'))
+    new = [obj for obj in objects.values() if (
+        ContentType.objects.get_for_model(obj).pk, smart_unicode(obj.pk))
+        not in existing]
+    if not new:
+        return []
+    follows = [Follow(
+        user=user,
+        object_id=obj.pk,
+        content_type=ContentType.objects.get_for_model(obj),
+        actor_only=actor_only,
+        site_id=_settings.SITE_ID,
+    ) for obj in new]
+    sid = transaction.savepoint()
+    try:
+        Follow.objects.bulk_create(follows)
+    except IntegrityError:
+        # some of them were followed concurrently, fall back to one by one
+        transaction.savepoint_rollback(sid)
+        follows = [follow for follow in follows if _insert_follow(follow)]
+    else:
+        transaction.savepoint_commit(sid)
+        # bulk_create does not set the primary keys
+        ids = dict(((content_type_id, object_id), pk) for
+            content_type_id, object_id, pk in Follow.objects.filter(
+                _objects_q(new), user=user).values_list(
+                'content_type_id', 'object_id', 'pk'))
+        for follow in follows:
+            follow.pk = ids[(follow.content_type_id,
+                             smart_unicode(follow.object_id))]
+    inserted = set((follow.content_type_id, smart_unicode(follow.object_id))
+                   for follow in follows)
+    new = [obj for obj in new if (ContentType.objects.get_for_model(obj).pk,
+                                  smart_unicode(obj.pk)) in inserted]
+    follow_cache.invalidate(user)
+    feed_plan.invalidate(user)
+    _count_follows(user, [(follow.content_type_id, follow.object_id)
+                          for follow in follows], 1)
+
+    if fanout.is_enabled('user'):
+        for follow in follows:
+            fanout.backfill_follow(follow)
+    if send_action and new:
+        bulk_action({
+            'actor': user,
+            'verb': _settings.FOLLOW_VERB,
+            'target': obj,
+            'batch_time_minutes': 30,
+            'is_batchable': True,
+        } for obj in new)
+        notices = [task_notice.subtask(
+            (_follow_recipients(obj), "follower", {'target': obj}),
+            {'sender': user}) for obj in new if _notifies_follow(obj)]
+        if notices:
+            group(notices).apply_async()
+
+    return follows
+
+
+def _insert_follow(follow):
+    """
+    Inserts ``follow`` unless the user already follows the object.
+    Returns True if it was inserted.
+    """
+    sid = transaction.savepoint()
+    try:
+        follow.save(force_insert=True)
+    except IntegrityError:
+        # lost the race against a concurrent follow of the same object
+        transaction.savepoint_rollback(sid)
+        follow.pk = None
+        return False
+    transaction.savepoint_commit(sid)
+    return True
+
+
+def unfollow_many(user, objects, send_action=False):
+    """
+    Removes the "follow" relationships of ``user`` with all ``objects`` using
+    a single delete query.
+
+    Set ``send_action`` to ``True`` to also record the
+    ``<user> stopped following <object>`` actions with ``bulk_action``.
+    """
+    from actstream.models import Follow
+
+    objects = list(objects)
+    for model in set(obj.__class__ for obj in objects):
+        check_actionable_model(model)
+    if not objects:
+        return
+    follows = Follow.objects.filter(_objects_q(objects), user=user)
+    counted = list(follows.filter(site=_settings.SITE_ID).values_list(
+        'content_type_id', 'object_id'))
+    follows.delete()
+    follow_cache.invalidate(user)
+    feed_plan.invalidate(user)
+    _count_follows(user, counted, -1)
+    if fanout.is_enabled('user'):
+        for obj in objects:
+            fanout.prune_unfollow(user, obj)
+    if send_action:
+        bulk_action({'actor': user, 'verb': _settings.UNFOLLOW_VERB,
+                     'target': obj} for obj in objects)
+
+
 def is_following(user, obj):
     """
     Checks if a "follow" relationship exists.
@@ -101,89 +300,225 @@ def is_following(user, obj):
 
         is_following(request.user, group)
     """
-    from actstream.models import Follow
-
     check_actionable_model(obj)
-    return bool(Follow.objects.filter(
-        user=user,
-        object_id=obj.pk,
-        content_type=ContentType.objects.get_for_model(obj),
+    return follow_cache.is_following(user, obj)
+
+
+def _new_action(actor, verb, kwargs, check=check_actionable_model,
+                content_type=ContentType.objects.get_for_model):
+    """
+    Returns the unsaved Action described by the arguments of ``action.send``.
+    Unknown arguments are stored in ``Action.data`` when it is enabled.
+    """
+    from actstream.models import Action, to_date
+
+    check(actor)
+    timestamp = kwargs.pop('timestamp', now())
+    newaction = Action(
+        actor_content_type=content_type(actor),
+        actor_object_id=actor.pk,
+        verb=unicode(verb),
+        public=bool(kwargs.pop('public', True)),
+        description=kwargs.pop('description', None),
+        timestamp=timestamp,
+        timestamp_date=to_date(timestamp),
+        batch_time_minutes=kwargs.pop('batch_time_minutes', 30),
+        is_batchable=kwargs.pop('is_batchable', False),
         site_id=_settings.SITE_ID
-    ).count())
+    )
+
+    for opt in ('target', 'action_object'):
+        obj = kwargs.pop(opt, None)
+        if not obj is None:
+            check(obj)
+            setattr(newaction, '%s_object_id' % opt, obj.pk)
+            setattr(newaction, '%s_content_type' % opt, content_type(obj))
+    if settings.USE_JSONFIELD and len(kwargs):
+        newaction.data = kwargs
+    return newaction
+
+
+def _action_inserted(action):
+    """
+    Batches, fans out and publishes a newly inserted action. The cached actor
+    stream and the watermark are kept up to date by the post_save handlers.
+    """
+    if settings.BATCH_GROUPS:
+        batching.assign_batch_group(action)
+    if fanout.is_enabled('user'):
+        fanout.fanout_action(action)
+    pubsub.publish_action(action)
 
 
 def action_handler(verb, **kwargs):
     """
     Handler function to create Action instance upon action signal call.
-    """
-    from actstream.models import Action
 
+    A published action of the same actor, verb, target, action object and
+    site already recorded that day only gets its timestamp refreshed.
+    """
     kwargs.pop('signal', None)
     actor = kwargs.pop('sender')
-    check_actionable_model(actor)
-    if check_action_exists(actor, verb, **kwargs):
-        newaction = Action(
-            actor_content_type=ContentType.objects.get_for_model(actor),
-            actor_object_id=actor.pk,
-            verb=unicode(verb),
-            public=bool(kwargs.pop('public', True)),
-            description=kwargs.pop('description', None),
-            timestamp=kwargs.pop('timestamp', now()),
-            batch_time_minutes=kwargs.pop('batch_time_minutes', 30),
-            is_batchable=kwargs.pop('is_batchable', False),
-            site_id=_settings.SITE_ID
-        )
+    newaction = _new_action(actor, verb, kwargs)
+    if ingestion.is_buffered():
+        ingestion.enqueue(newaction)
+    elif upsert_action(newaction):
+        _action_inserted(newaction)
+    else:
+        # the refreshed action moved to the top of its actor's stream
+        stream_cache.invalidate(newaction)
 
-        for opt in ('target', 'action_object'):
-            obj = kwargs.pop(opt, None)
-            if not obj is None:
-                check_actionable_model(obj)
-                setattr(newaction, '%s_object_id' % opt, obj.pk)
-                setattr(newaction, '%s_content_type' % opt,
-                        ContentType.objects.get_for_model(obj))
-        if settings.USE_JSONFIELD and len(kwargs):
-            newaction.data = kwargs
-        newaction.save()
 
+def bulk_action(actions, batch_size=500):
+    """
+    Records many actions at once, writing them with ``bulk_create``.
 
-def check_action_exists(actor, verb, **kwargs):
-    from actstream.models import Action
+    ``actions`` is an iterable of dicts holding the arguments of
+    ``action.send`` with the actor passed as ``actor``. It is consumed
+    ``batch_size`` items at a time, so a generator keeps huge imports in
+    constant memory. Same-day duplicates collapse like with ``action.send``,
+    but other receivers of the ``action`` signal are not called.
 
-    filters = {
-        'actor_content_type': ContentType.objects.get_for_model(actor),
-        'actor_object_id': actor.pk,
-        'verb': unicode(verb),
-        'state': 1,
-        'timestamp_date': kwargs.get('timestamp', now()),
-        'site_id': _settings.SITE_ID,
-    }
-    for opt in ('target', 'action_object'):
-        obj = kwargs.pop(opt, None)
-        if not obj is None:
-            check_actionable_model(obj)
-            filters.update({'%s_object_id' % opt: obj.pk})
-            filters.update({'%s_content_type' % opt: ContentType.objects.get_for_model(obj)})
+    Returns the number of actions inserted.
 
-    try:
-        action = Action.objects.get(**filters)
+    Example::
 
-        action.timestamp = kwargs.get('timestamp', now())
-        action.save()
+        bulk_action({'actor': request.user, 'verb': 'followed', 'target': obj}
+                    for obj in objects)
+    """
+    checked, content_types = set(), {}
 
-    except Action.DoesNotExist:
-        return True
+    def check(obj):
+        if obj.__class__ not in checked:
+            check_actionable_model(obj)
+            checked.add(obj.__class__)
+
+    def content_type(obj):
+        if obj.__class__ not in content_types:
+            content_types[obj.__class__] = \
+                ContentType.objects.get_for_model(obj)
+        return content_types[obj.__class__]
+
+    actions, inserted = iter(actions), 0
+    while True:
+        batch = []
+        for kwargs in islice(actions, batch_size):
+            kwargs = dict(kwargs)
+            batch.append(_new_action(kwargs.pop('actor'), kwargs.pop('verb'),
+                                     kwargs, check, content_type))
+        if not batch:
+            return inserted
+        inserted += len(save_actions(batch))
+
+
+def refresh_action(dedup_key, timestamp):
+    """
+    Moves the published action with the given dedup key to ``timestamp``.
+    Returns the number of updated actions (0 or 1).
+    """
+    from actstream.models import Action
 
-    except Action.MultipleObjectsReturned:
-        actions = Action.objects.filter(**filters).order_by('-id')
-        i = 1
-        for action in actions:
-            if i == 1:
-                action.timestamp = kwargs.get('timestamp', now())
-                action.save()
-                i += 1
-            else:
-                action.delete()
+    updated = Action.objects.filter(dedup_key=dedup_key).update(
+        timestamp=timestamp)
+    if updated and fanout.is_enabled('user'):
+        fanout.touch_actions(timestamp, dedup_key=dedup_key)
+    return updated
 
-    return False
 
+def upsert_action(newaction):
+    """
+    Saves ``newaction`` unless a published action with the same dedup key
+    exists, in which case that action's timestamp is refreshed instead.
+    Relies on the unique ``dedup_key`` so concurrent sends can not both
+    insert. Returns True if ``newaction`` was inserted.
+    """
+    newaction.dedup_key = newaction.get_dedup_key()
+    if refresh_action(newaction.dedup_key, newaction.timestamp):
+        return False
+    sid = transaction.savepoint()
+    try:
+        newaction.save(force_insert=True)
+    except IntegrityError:
+        # lost the race against a concurrent send of the same action
+        transaction.savepoint_rollback(sid)
+        newaction.pk = None
+        refresh_action(newaction.dedup_key, newaction.timestamp)
+        return False
+    transaction.savepoint_commit(sid)
+    return True
+
+
+def save_actions(actions):
+    """
+    Saves unsaved actions with ``bulk_create``, applying the deduplication of
+    ``action_handler``: actions already recorded that day, or repeated in
+    ``actions``, only refresh the timestamp of the recorded action.
+    Returns the list of inserted actions.
+    """
+    from actstream.models import Action
 
+    latest = {}
+    for action in actions:
+        action.dedup_key = action.get_dedup_key()
+        current = latest.get(action.dedup_key)
+        if current is None or action.timestamp > current.timestamp:
+            latest[action.dedup_key] = action
+    if not latest:
+        return []
+
+    existing = set(Action.objects.filter(dedup_key__in=latest.keys())
+                   .values_list('dedup_key', flat=True))
+    for dedup_key in existing:
+        refresh_action(dedup_key, latest[dedup_key].timestamp)
+        stream_cache.invalidate(latest[dedup_key])
+    new = sorted([action for dedup_key, action in latest.items()
+                  if dedup_key not in existing], key=lambda a: a.timestamp)
+    if not new:
+        return []
+
+    sid = transaction.savepoint()
+    try:
+        Action.objects.bulk_create(new)
+    except IntegrityError:
+        # some of them were sent concurrently, fall back to one by one
+        transaction.savepoint_rollback(sid)
+        new = [action for action in new if upsert_action(action)]
+    else:
+        transaction.savepoint_commit(sid)
+        # bulk_create does not set the primary keys nor send post_save
+        ids = dict(Action.objects.filter(
+            dedup_key__in=[a.dedup_key for a in new]).values_list(
+            'dedup_key', 'id'))
+        for action in new:
+            action.pk = ids[action.dedup_key]
+            stream_cache.push(action)
+            watermark.raise_to(action)
+    for action in new:
+        _action_inserted(action)
+    return new
+
+
+def check_action_exists(actor, verb, **kwargs):
+    """
+    Refreshes the timestamp of the published action of the day matching
+    ``actor``, ``verb`` and the optional ``target``/``action_object``.
+    Returns True if there is no such action yet.
+    """
+    from actstream.models import Action, to_date
+
+    timestamp = kwargs.get('timestamp', now())
+    action = Action(
+        actor_content_type=ContentType.objects.get_for_model(actor),
+        actor_object_id=actor.pk,
+        verb=unicode(verb),
+        timestamp_date=to_date(timestamp),
+        site_id=_settings.SITE_ID,
+    )
+    for opt in ('target', 'action_object'):
+        obj = kwargs.pop(opt, None)
+        if not obj is None:
+            check_actionable_model(obj)
+            setattr(action, '%s_object_id' % opt, obj.pk)
+            setattr(action, '%s_content_type' % opt,
+                    ContentType.objects.get_for_model(obj))
+    return not refresh_action(action.get_dedup_key(), timestamp)
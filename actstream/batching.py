@@ -0,0 +1,247 @@
+"""
+Grouping of batchable actions for feed pages.
+
+Batchable actions (``Action.is_batchable``) of a page collapse the actions of
+the feed that happened within ``batch_time_minutes`` before them: follows of
+the same actor on the same kind of target, or any other verb on the same
+target. The candidate window of the whole page is fetched with one query and
+grouped in memory.
+
+The batches can also be recorded as actions are written: every batchable
+action gathers the actions of its window, and their batches, under its own id
+in ``Action.batch_group``, so a feed keeps the newest action of each batch
+with a filter (``collapse_batches``). Batches are shared by every feed, a feed
+missing the head of a batch has it headed by its newest action of the batch.
+"""
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import timedelta
+from itertools import chain
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils.encoding import smart_unicode
+
+ACTIVITY_DEFAULT_BATCH_TIME = 30
+
+
+def batch_window(action, default_minutes=ACTIVITY_DEFAULT_BATCH_TIME):
+    """
+    Returns the timedelta before an action within which it batches others
+    """
+    return timedelta(minutes=action.batch_time_minutes or default_minutes)
+
+
+def group_key(verb, actor_content_type_id, actor_object_id,
+              target_content_type_id, target_object_id, follow_verb):
+    """
+    Returns the key shared by the actions batched together: follows are
+    grouped per actor, other verbs per target.
+    """
+    if verb == follow_verb:
+        return (verb, actor_content_type_id, smart_unicode(actor_object_id),
+                target_content_type_id)
+    return (verb, actor_content_type_id, target_content_type_id,
+            target_object_id and smart_unicode(target_object_id))
+
+
+def _action_key(action, follow_verb):
+    return group_key(action.verb, action.actor_content_type_id,
+                     action.actor_object_id, action.target_content_type_id,
+                     action.target_object_id, follow_verb)
+
+
+def group_actions(queryset, activities, batched_actions=None,
+                  follow_verb=None,
+                  default_minutes=ACTIVITY_DEFAULT_BATCH_TIME):
+    """
+    Maps the id of every batchable action of ``activities`` (a page of
+    ``queryset``) to the ids of the actions of ``queryset`` it batches, newest
+    first. ``batched_actions``, the mapping of the previous pages, is extended
+    in place and the actions it already batches are skipped. Returns the
+    mapping.
+    """
+    if batched_actions is None:
+        batched_actions = {}
+    if follow_verb is None:
+        follow_verb = settings.FOLLOW_VERB
+    parents = [a for a in activities if a.is_batchable]
+    if not parents:
+        return batched_actions
+
+    # one query for the window of every batchable action of the page
+    candidates = queryset.filter(
+        timestamp__gte=min(a.timestamp - batch_window(a, default_minutes)
+                           for a in parents),
+        timestamp__lte=max(a.timestamp for a in parents),
+        verb__in=set(a.verb for a in parents),
+    ).order_by().values_list(
+        'id', 'timestamp', 'verb', 'actor_content_type', 'actor_object_id',
+        'target_content_type', 'target_object_id')
+
+    buckets = defaultdict(list)
+    for row in candidates:
+        buckets[group_key(*(row[2:] + (follow_verb,)))].append(row[:2])
+    groups = {}
+    for key, rows in buckets.items():
+        rows.sort(key=lambda row: (row[1], row[0]))
+        groups[key] = ([timestamp for pk, timestamp in rows],
+                       [pk for pk, timestamp in rows])
+
+    batched = set(chain.from_iterable(batched_actions.values()))
+    for activity in parents:
+        if activity.id in batched:
+            continue
+        group = groups.get(_action_key(activity, follow_verb))
+        if group is None:
+            continue
+        timestamps, ids = group
+        start = bisect_left(timestamps,
+                            activity.timestamp - batch_window(activity,
+                                                              default_minutes))
+        end = bisect_right(timestamps, activity.timestamp)
+        children = batched_actions.get(activity.id, [])
+        known = set(children)
+        for pk in reversed(ids[start:end]):
+            if pk != activity.id and pk not in known:
+                children.append(pk)
+                known.add(pk)
+                batched.add(pk)
+        if children:
+            batched_actions[activity.id] = children
+    return batched_actions
+
+
+def batch_lookup(action, follow_verb=None):
+    """
+    Returns the filter arguments selecting the actions of the group of
+    ``action``, or None when it can not batch other actions.
+    """
+    if follow_verb is None:
+        follow_verb = settings.FOLLOW_VERB
+    lookup = {
+        'verb': action.verb,
+        'actor_content_type': action.actor_content_type_id,
+        'target_content_type': action.target_content_type_id,
+        'site': action.site_id,
+    }
+    if action.verb == follow_verb:
+        lookup['actor_object_id'] = action.actor_object_id
+    elif action.target_object_id is None:
+        return None
+    else:
+        lookup['target_object_id'] = action.target_object_id
+    return lookup
+
+
+def assign_batch_group(action, follow_verb=None,
+                       default_minutes=ACTIVITY_DEFAULT_BATCH_TIME):
+    """
+    Makes a newly saved batchable action the head of the batch of the
+    published actions of its group within its window, merging the batches
+    they already belong to. Returns the batch group id, or None when there
+    is nothing to batch.
+    """
+    from actstream.models import Action
+
+    lookup = action.is_batchable and batch_lookup(action, follow_verb)
+    if not lookup:
+        return None
+    members = Action.objects.public(
+        timestamp__gte=action.timestamp - batch_window(action, default_minutes),
+        timestamp__lte=action.timestamp,
+        **lookup
+    ).exclude(id=action.pk).values_list('id', 'batch_group')
+    ids, groups = set([action.pk]), set()
+    for pk, group in members:
+        ids.add(pk)
+        if group is not None:
+            groups.add(group)
+    if len(ids) == 1:
+        return None
+    Action.objects.filter(Q(id__in=ids) | Q(batch_group__in=groups)).update(
+        batch_group=action.pk)
+    action.batch_group = action.pk
+    return action.pk
+
+
+def collapse_batches(queryset):
+    """
+    Filters ``queryset`` down to the actions that are not batched by a newer
+    action of ``queryset``, using the batch groups recorded at write time.
+    Batches are recorded for every feed at once, so the actions of a batch
+    whose head is not in ``queryset`` (eg. an action of an actor the user
+    does not follow) are kept, for ``batched_children`` to group.
+    """
+    heads = queryset.filter(batch_group=F('id')).order_by().values('id')
+    return queryset.filter(Q(batch_group__isnull=True) |
+                           Q(batch_group=F('id')) |
+                           ~Q(batch_group__in=heads))
+
+
+def batched_children(queryset, activities):
+    """
+    Maps the id of every batch head of ``activities`` to the ids of the
+    other actions of ``queryset`` in its batch, newest first, with one query.
+    A batch whose head is not in ``queryset`` is headed by its newest action
+    in ``queryset`` instead.
+    """
+    groups = set(a.batch_group for a in activities
+                 if a.batch_group is not None)
+    batched_actions = {}
+    if not groups:
+        return batched_actions
+    members = queryset.filter(batch_group__in=groups).order_by(
+        '-timestamp', '-id').values_list('batch_group', 'id')
+    batches = defaultdict(list)
+    for group, pk in members:
+        batches[group].append(pk)
+    page = set(a.id for a in activities)
+    for group, ids in batches.items():
+        head = group if group in ids else ids[0]
+        children = [pk for pk in ids if pk != head]
+        # a batch headed on a previous page is already mapped
+        if head in page and children:
+            batched_actions[head] = children
+    return batched_actions
+
+
+def resolve_batches(batched_actions, parent_ids=None):
+    """
+    Loads the actions of the batches of ``parent_ids`` (every batch of
+    ``batched_actions`` by default), parents included, with their actors and
+    targets in one query per model. Returns the actions by id.
+    """
+    from actstream.models import Action
+
+    if parent_ids is None:
+        parent_ids = batched_actions.keys()
+    ids = set()
+    for parent_id in parent_ids:
+        ids.add(parent_id)
+        ids.update(batched_actions.get(parent_id) or ())
+    if not ids:
+        return {}
+    # fetch_generic_relations registers them in the request's identity map
+    return dict((action.pk, action) for action in Action.objects.filter(
+        pk__in=ids).fetch_generic_relations('actor', 'target'))
+
+
+def batched_objects(actions, action_ids, parent_id, field):
+    """
+    Returns the distinct ``field`` objects (``'actor'`` or ``'target'``) of
+    the batched ``action_ids`` other than the parent's, from the actions
+    loaded by ``resolve_batches``.
+    """
+    parent = actions.get(parent_id)
+    excluded = getattr(parent, field) if parent is not None else None
+    objects, seen = [], set()
+    for pk in action_ids:
+        if pk not in actions:
+            continue
+        obj = getattr(actions[pk], field)
+        if obj is None or obj == excluded or obj in seen:
+            continue
+        seen.add(obj)
+        objects.append(obj)
+    return objects
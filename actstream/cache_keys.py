@@ -0,0 +1,72 @@
+"""
+Keys of the entries actstream stores in Django's cache.
+
+Keys are namespaced, include the current site and hash their variable parts,
+so they stay short and free of the spaces and control characters memcached
+rejects whatever usernames or object ids they are built from. Keys of a
+user's feed state also include a generation counter of that user:
+``invalidate_user`` increments it, which orphans every entry built from the
+previous generation at once.
+"""
+import hashlib
+import time
+
+from django.conf import settings as _settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+
+KEY_PREFIX = 'actstream'
+
+# generation counters must outlive the entries they version
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def make_key(namespace, *parts):
+    """
+    Returns the key of the ``namespace`` entry identified by ``parts``
+    """
+    digest = hashlib.sha1(smart_str(u':'.join(
+        [unicode(part) for part in parts]))).hexdigest()
+    return '%s:%s:%s:%s' % (KEY_PREFIX, namespace, _settings.SITE_ID, digest)
+
+
+def _user_id(user):
+    return getattr(user, 'pk', user)
+
+
+def _generation_key(user):
+    return make_key('generation', _user_id(user))
+
+
+def generation(user):
+    """
+    Returns the current generation of the cached state of a user (instance
+    or id).
+    """
+    key = _generation_key(user)
+    value = cache.get(key)
+    if value is None:
+        # seeded with the time so a counter evicted from the cache does not
+        # come back to a generation still in use
+        cache.add(key, int(time.time()), GENERATION_TIMEOUT)
+        value = cache.get(key, int(time.time()))
+    return value
+
+
+def user_key(user, namespace, *parts):
+    """
+    Returns the key of a ``namespace`` entry of a user's state, versioned by
+    the user's generation.
+    """
+    return make_key(namespace, _user_id(user), generation(user), *parts)
+
+
+def invalidate_user(user):
+    """
+    Invalidates every entry built with ``user_key`` for a user
+    """
+    key = _generation_key(user)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time()), GENERATION_TIMEOUT)
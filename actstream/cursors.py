@@ -0,0 +1,64 @@
+"""
+Keyset pagination for action streams.
+
+A cursor is an opaque, URL safe token encoding the ``(timestamp, id)`` of the
+last action of a page. Streams are ordered by ``-timestamp``, so seeking past
+a cursor is an indexed range condition instead of an ``OFFSET`` that has to
+skip every previous row.
+"""
+import base64
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from actstream.exceptions import BadCursor
+
+
+def encode_cursor(action):
+    """
+    Returns the cursor token pointing at the given action
+    """
+    value = '%s|%s' % (action.timestamp.isoformat(), action.pk)
+    return base64.urlsafe_b64encode(value).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the ``(timestamp, id)`` tuple of a cursor token. Tuples are
+    returned unchanged. Raises ``BadCursor`` for invalid tokens.
+    """
+    if isinstance(cursor, tuple):
+        return cursor
+    try:
+        cursor = str(cursor)
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, pk = value.rsplit('|', 1)
+        timestamp = parse_datetime(timestamp)
+        if timestamp is None:
+            raise ValueError(value)
+        return timestamp, int(pk)
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise BadCursor(cursor)
+
+
+def seek(queryset, before=None, after=None):
+    """
+    Restricts an action queryset to the actions older than ``before`` and/or
+    newer than ``after``.
+
+    Actions before the cursor are returned newest first. Actions after it are
+    returned oldest first so that slicing keeps the ones adjacent to the
+    cursor.
+    """
+    ordering = ('-timestamp', '-id')
+    if before is not None:
+        timestamp, pk = decode_cursor(before)
+        queryset = queryset.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+    if after is not None:
+        timestamp, pk = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+        if before is None:
+            ordering = ('timestamp', 'id')
+    return queryset.order_by(*ordering)
@@ -1,5 +1,7 @@
 from functools import wraps
 
+from actstream.cursors import seek
+
 
 def stream(func):
     """
@@ -15,13 +17,22 @@ def stream(func):
             def foobar(self, ...):
                 ...
 
+    Streams accept ``_offset``/``_limit`` to slice the result and the
+    ``_before``/``_after`` cursors (see ``actstream.cursors``) to page through
+    it by seeking on ``(timestamp, id)`` instead of using an offset.
     """
     @wraps(func)
     def wrapped(manager, *args, **kwargs):
         offset, limit = kwargs.pop('_offset', None), kwargs.pop('_limit', None)
+        before, after = kwargs.pop('_before', None), kwargs.pop('_after', None)
+        queryset = func(manager, *args, **kwargs)
+        if before is not None or after is not None:
+            queryset = seek(queryset, before=before, after=after)
+        queryset = queryset[offset:limit]
         try:
-            return func(manager, *args, **kwargs)[offset:limit]\
-                .fetch_generic_relations()
+            return queryset.fetch_generic_relations()
         except AttributeError:
-            return func(manager, *args, **kwargs).fetch_generic_relations()
+            # not a GFKQuerySet, return it as it is rather than running the
+            # stream again without its slice and cursors
+            return queryset
     return wrapped
@@ -1,7 +1,7 @@
 from django.db.models.base import ModelBase
 from django.core.exceptions import ImproperlyConfigured
 
-from actstream.settings import get_models
+from actstream.settings import get_actionable_models
 
 
 class ModelNotActionable(ImproperlyConfigured):
@@ -25,6 +25,12 @@ class BadQuerySet(ValueError):
     Action stream must return a QuerySet of Action items.
     """
 
+
+class BadCursor(ValueError):
+    """
+    Raised when a stream pagination cursor cannot be decoded.
+    """
+
 def is_model(obj):
     """
     Returns True if the obj is a Django model
@@ -41,5 +47,5 @@ def check_actionable_model(model):
     ``ModelNotActionable`` exception.
     """
     model = model if hasattr(model, 'objects') else model.__class__
-    if not model in get_models().values():
+    if not model in get_actionable_models():
         raise ModelNotActionable(model)
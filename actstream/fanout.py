@@ -0,0 +1,146 @@
+"""
+Fan-out-on-write support for streams.
+
+Streams listed in ``ACTSTREAM_SETTINGS['FANOUT_ON_WRITE']`` are materialized
+into ``InboxEntry`` rows when an action is saved, so reading them is a single
+indexed scan of the inbox instead of a query built from every ``Follow`` of
+the user.
+"""
+from django.db.models import Q
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
+
+from actstream import settings
+
+
+def is_enabled(stream_name='user'):
+    """
+    Returns True if the named stream is fanned out on write
+    """
+    return stream_name in settings.FANOUT_ON_WRITE
+
+
+def follower_ids(action):
+    """
+    Returns the set of ids of the users whose ``user`` stream contains the
+    given action. Applies the same rules as ``ActionManager.followed_actions``.
+    """
+    from actstream.models import Follow
+
+    actor = (action.actor_content_type_id, smart_unicode(action.actor_object_id))
+    target = None
+    q = Q(content_type=actor[0], object_id=actor[1])
+    for opt in ('target', 'action_object'):
+        content_type_id = getattr(action, '%s_content_type_id' % opt)
+        object_id = getattr(action, '%s_object_id' % opt)
+        if content_type_id is None or object_id is None:
+            continue
+        if opt == 'target':
+            target = (content_type_id, smart_unicode(object_id))
+        q = q | Q(content_type=content_type_id, object_id=object_id,
+                  actor_only=False)
+
+    matched, excluded = set(), set()
+    follows = Follow.objects.filter(q).values_list(
+        'user_id', 'content_type_id', 'object_id', 'actor_only')
+    for user_id, content_type_id, object_id, actor_only in follows.iterator():
+        matched.add(user_id)
+        if (not actor_only and action.verb.startswith('viewed') and
+                (content_type_id, smart_unicode(object_id)) == target):
+            excluded.add(user_id)
+
+    if actor[0] == ContentType.objects.get_for_model(User).pk:
+        excluded.add(int(actor[1]))
+    return matched - excluded
+
+
+def fanout_action(action):
+    """
+    Writes an inbox entry for every user following the action
+    """
+    from actstream.models import InboxEntry
+
+    InboxEntry.objects.bulk_create([
+        InboxEntry(user_id=user_id, action_id=action.pk,
+                   timestamp=action.timestamp)
+        for user_id in follower_ids(action)
+    ])
+
+
+def touch_actions(timestamp, **filters):
+    """
+    Moves the inbox entries of the actions matching ``filters`` to
+    ``timestamp``, keeping them in sync with refreshed actions.
+    """
+    from actstream.models import InboxEntry
+
+    InboxEntry.objects.filter(**dict(
+        ('action__%s' % lookup, value) for lookup, value in filters.items()
+    )).update(timestamp=timestamp)
+
+
+def backfill_user(user, batch_size=500, queryset=None):
+    """
+    Writes the missing inbox entries of ``user`` for the actions of the objects
+    they follow. ``queryset`` restricts the actions considered.
+    Returns the number of entries created.
+    """
+    from actstream.models import Action, InboxEntry
+
+    if queryset is None:
+        queryset = Action.objects.followed_actions(user)
+    existing = set(InboxEntry.objects.filter(user=user).values_list(
+        'action_id', flat=True))
+    created, batch = 0, []
+    for action_id, timestamp in queryset.values_list('id', 'timestamp')\
+            .iterator():
+        if action_id in existing:
+            continue
+        batch.append(InboxEntry(user=user, action_id=action_id,
+                                timestamp=timestamp))
+        if len(batch) >= batch_size:
+            InboxEntry.objects.bulk_create(batch)
+            created, batch = created + len(batch), []
+    if batch:
+        InboxEntry.objects.bulk_create(batch)
+        created += len(batch)
+    return created
+
+
+def _object_q(content_type, object_id, actor_only=False):
+    q = Q(actor_content_type=content_type, actor_object_id=object_id)
+    if not actor_only:
+        q = q | Q(target_content_type=content_type, target_object_id=object_id)\
+            | Q(action_object_content_type=content_type,
+                action_object_object_id=object_id)
+    return q
+
+
+def backfill_follow(follow):
+    """
+    Adds the existing actions of a newly followed object to the follower's
+    inbox.
+    """
+    from actstream.models import Action
+
+    queryset = Action.objects.followed_actions(follow.user).filter(
+        _object_q(follow.content_type_id, follow.object_id, follow.actor_only))
+    return backfill_user(follow.user, queryset=queryset)
+
+
+def prune_unfollow(user, obj):
+    """
+    Removes the inbox entries of ``user`` that were only there because they
+    followed ``obj``.
+    """
+    from actstream.models import Action, InboxEntry
+
+    content_type = ContentType.objects.get_for_model(obj)
+    candidates = Action.objects.filter(
+        _object_q(content_type, obj.pk), inbox_entries__user=user)
+    still_followed = Action.objects.followed_actions(user).filter(
+        id__in=candidates.values('id')).values_list('id', flat=True)
+    stale = set(candidates.values_list('id', flat=True)) - set(still_followed)
+    if stale:
+        InboxEntry.objects.filter(user=user, action__in=stale).delete()
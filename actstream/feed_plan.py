@@ -0,0 +1,51 @@
+"""
+Cache of follower feed plans.
+
+Building the follower feed of a user reads the content types of the objects
+it follows that can also be followed with django-follow and the blog posts
+left out of it. The polling endpoints rebuild that feed every few seconds, so this
+resolved "plan" is kept in Django's cache for ``FEED_PLAN_CACHE_TIMEOUT``
+seconds and dropped when the user follows or unfollows something, through
+actstream or django-follow. Plans of feeds of other actors than the user only
+expire.
+"""
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+
+from actstream import cache_keys, settings
+
+
+def cache_key(user, content_type_id, object_id):
+    return cache_keys.user_key(user, 'feed_plan', content_type_id, object_id)
+
+
+def get_plan(user, actor, build):
+    """
+    Returns the cached plan of the feed of ``actor`` as seen by ``user``,
+    calling ``build`` to make it when it is not cached.
+    """
+    key = cache_key(user, ContentType.objects.get_for_model(actor).pk,
+                    actor.pk)
+    plan = cache.get(key)
+    if plan is None:
+        plan = build()
+        cache.set(key, plan, settings.FEED_PLAN_CACHE_TIMEOUT)
+    return plan
+
+
+def invalidate(user):
+    """
+    Drops the plan of the feed of a user (instance or id)
+    """
+    user_id = getattr(user, 'pk', user)
+    cache.delete(cache_key(user_id, ContentType.objects.get_for_model(User).pk,
+                           user_id))
+
+
+def invalidate_follow(sender, instance, **kwargs):
+    """
+    Signal handler dropping the feed plan of the user of a saved or deleted
+    actstream or django-follow ``Follow``.
+    """
+    invalidate(instance.user_id)
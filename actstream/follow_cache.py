@@ -0,0 +1,81 @@
+"""
+Cache of the objects each user follows.
+
+``is_following`` is called for every follow button of a page. Instead of a
+query per call, the ``(content_type_id, object_id)`` pairs followed by the
+user are loaded once, kept in Django's cache and memoized on the user
+instance for the rest of the request. ``follow``/``unfollow`` and changes to
+``Follow`` rows invalidate it.
+"""
+from django.conf import settings as _settings
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
+
+from actstream import cache_keys, settings
+
+MEMO_ATTR = '_actstream_followed_set'
+
+
+def cache_key(user):
+    return cache_keys.user_key(user, 'followed')
+
+
+def _load(user):
+    from actstream.models import Follow
+
+    followed = {}
+    for content_type_id, object_id in Follow.objects.filter(
+            user=user, site_id=_settings.SITE_ID).values_list(
+            'content_type_id', 'object_id').iterator():
+        followed.setdefault(content_type_id, []).append(object_id)
+    # stored compactly as {content_type_id: (object_id, ...)}
+    return dict((content_type_id, tuple(object_ids)) for content_type_id,
+                object_ids in followed.items())
+
+
+def get_followed_set(user):
+    """
+    Returns the frozenset of ``(content_type_id, object_id)`` pairs the user
+    follows on the current site.
+    """
+    followed = getattr(user, MEMO_ATTR, None)
+    if followed is not None:
+        return followed
+    key = cache_key(user.pk)
+    compact = cache.get(key)
+    if compact is None:
+        compact = _load(user)
+        cache.set(key, compact, settings.FOLLOW_CACHE_TIMEOUT)
+    followed = frozenset((content_type_id, smart_unicode(object_id))
+                         for content_type_id, object_ids in compact.items()
+                         for object_id in object_ids)
+    setattr(user, MEMO_ATTR, followed)
+    return followed
+
+
+def is_following(user, obj):
+    """
+    Returns True if the user follows ``obj``
+    """
+    key = (ContentType.objects.get_for_model(obj).pk, smart_unicode(obj.pk))
+    return key in get_followed_set(user)
+
+
+def invalidate(user):
+    """
+    Forgets the followed set of a user (instance or id)
+    """
+    if hasattr(user, 'pk'):
+        if hasattr(user, MEMO_ATTR):
+            delattr(user, MEMO_ATTR)
+        user = user.pk
+    cache.delete(cache_key(user))
+
+
+def invalidate_follow(sender, instance, **kwargs):
+    """
+    Signal handler invalidating the followed set of a saved or deleted
+    ``Follow``'s user.
+    """
+    invalidate(instance.user_id)
@@ -1,3 +1,5 @@
+from collections import defaultdict
+
 from django.conf import settings
 from django.db.models import Manager
 from django.db.models.query import QuerySet, EmptyQuerySet
@@ -19,6 +21,81 @@ class GFKManager(Manager):
         return self.get_query_set().none()
 
 
+def _gfk_fields(model, names=()):
+    gfk_fields = [g for g in model._meta.virtual_fields
+                  if isinstance(g, GenericForeignKey)]
+    if names:
+        gfk_fields = filter(lambda g: g.name in names, gfk_fields)
+    return gfk_fields
+
+
+def attach_generic_relations(items, *args, **kwargs):
+    """
+    Sets the objects of the generic foreign keys of already loaded model
+    instances (all of the same model), with one query per content type.
+    ``args`` restricts it to the named generic foreign keys. Objects already
+    in the identity map or the object cache are not queried again.
+    """
+    from actstream.identity_map import get_identity_map
+    from actstream.object_cache import cache_key, get_object_cache
+    from actstream import settings as actstream_settings
+
+    if not items:
+        return items
+    model = items[0].__class__
+    using = kwargs.get('using')
+
+    # resolve the attribute names of every GFK once instead of per row
+    fields = [(gfk.cache_attr,
+               model._meta.get_field(gfk.ct_field).attname,
+               gfk.fk_field) for gfk in _gfk_fields(model, args)]
+
+    ct_map, data_map = defaultdict(set), {}
+    for item in items:
+        for cache_attr, ct_attr, fk_attr in fields:
+            ct_id, object_id = getattr(item, ct_attr), getattr(item, fk_attr)
+            if ct_id is None or object_id is None:
+                continue
+            ct_map[ct_id].add(smart_unicode(object_id))
+
+    # objects already loaded during the request, then cached ones
+    object_cache = get_object_cache()
+    identity_map = get_identity_map()
+    for source in (identity_map, object_cache):
+        if source is None:
+            continue
+        data_map.update(source.get_many([(ct_id, object_id)
+            for ct_id, object_ids in ct_map.items()
+            for object_id in object_ids]))
+        for ct_id, object_id in data_map:
+            ct_map[ct_id].discard(object_id)
+
+    ctypes = ContentType.objects.db_manager(using)
+    fetched = {}
+    for ct_id, object_ids in ct_map.items():
+        if not object_ids:
+            continue
+        model_class = ctypes.get_for_id(ct_id).model_class()
+        objects = model_class._default_manager.using(using)\
+            .select_related(depth=actstream_settings.GFK_FETCH_DEPTH)
+        for o in objects.filter(pk__in=object_ids):
+            fetched[(ct_id, smart_unicode(o.pk))] = o
+    if object_cache is not None and fetched:
+        object_cache.set_many(fetched)
+    data_map.update(fetched)
+    if identity_map is not None:
+        identity_map.add_many(data_map)
+        identity_map.add_many((cache_key(item), item) for item in items)
+
+    for item in items:
+        for cache_attr, ct_attr, fk_attr in fields:
+            key = (getattr(item, ct_attr),
+                   smart_unicode(getattr(item, fk_attr)))
+            if key in data_map:
+                setattr(item, cache_attr, data_map[key])
+    return items
+
+
 class GFKQuerySet(QuerySet):
     """
     A QuerySet with a fetch_generic_relations() method to bulk fetch
@@ -33,56 +110,23 @@ class GFKQuerySet(QuerySet):
     """
     def fetch_generic_relations(self, *args):
         from actstream import settings as actstream_settings
+        from actstream.identity_map import get_identity_map
+        from actstream.object_cache import get_object_cache
 
         qs = self._clone()
 
         if not actstream_settings.FETCH_RELATIONS:
             return qs
 
-        gfk_fields = [g for g in self.model._meta.virtual_fields
-                      if isinstance(g, GenericForeignKey)]
-        if args:
-            gfk_fields = filter(lambda g: g.name in args, gfk_fields)
-
-        if actstream_settings.USE_PREFETCH and hasattr(self, 'prefetch_related'):
-            return qs.prefetch_related(*[g.name for g in gfk_fields])
-
-        ct_map, data_map = {}, {}
-
-        for item in qs:
-            for gfk in gfk_fields:
-                if getattr(item, gfk.fk_field) is None:
-                    continue
-                ct_id_field = self.model._meta.get_field(gfk.ct_field).column
-                if getattr(item, ct_id_field) is None:
-                    continue
-                ct_map.setdefault(getattr(item, ct_id_field), {}
-                    )[smart_unicode(getattr(item, gfk.fk_field))] = (gfk.name,
-                        item.pk)
-
-        ctypes = ContentType.objects.using(self.db).in_bulk(ct_map.keys())
-
-        for ct_id, items_ in ct_map.items():
-            if ct_id:
-                ct = ctypes[ct_id]
-                model_class = ct.model_class()
-                objects = model_class._default_manager.select_related(
-                    depth=actstream_settings.GFK_FETCH_DEPTH)
-                for o in objects.filter(pk__in=items_.keys()):
-                    (gfk_name, item_id) = items_[smart_unicode(o.pk)]
-                    data_map[(ct_id, smart_unicode(o.pk))] = o
-
-        for item in qs:
-            for gfk in gfk_fields:
-                if getattr(item, gfk.fk_field) != None:
-                    ct_id_field = self.model._meta.get_field(gfk.ct_field)\
-                        .column
-                    setattr(item, gfk.name,
-                        data_map[(
-                            getattr(item, ct_id_field),
-                            smart_unicode(getattr(item, gfk.fk_field))
-                        )])
+        if actstream_settings.USE_PREFETCH and get_object_cache() is None \
+                and get_identity_map() is None and \
+                hasattr(self, 'prefetch_related'):
+            return qs.prefetch_related(*[g.name for g in
+                                         _gfk_fields(self.model, args)])
 
+        # evaluating qs here fills its result cache, so iterating the returned
+        # queryset does not hit the database again
+        attach_generic_relations(list(qs), *args, using=self.db)
         return qs
 
     def none(self):
@@ -90,5 +134,5 @@ class GFKQuerySet(QuerySet):
 
 
 class EmptyGFKQuerySet(GFKQuerySet, EmptyQuerySet):
-    def fetch_generic_relations(self):
+    def fetch_generic_relations(self, *args):
         return self
@@ -0,0 +1,131 @@
+"""
+Request-scoped identity map of actions and of the objects their generic
+foreign keys point at.
+
+While a map is active (see ``IdentityMapMiddleware``), the feed views register
+the actions they render and ``fetch_generic_relations`` the rows and related
+objects it loads, so template tags looking up the same action, actor or
+target again during the request do not query the database. Objects are keyed
+by ``(content_type_id, object_pk)``; ``hits`` and ``misses`` count the
+lookups for debugging.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
+
+from actstream.object_cache import cache_key
+
+_local = threading.local()
+
+
+class IdentityMap(object):
+    """
+    Objects loaded during the current request
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        try:
+            obj = self.objects[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return obj
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            obj = self.get(key)
+            if obj is not None:
+                found[key] = obj
+        return found
+
+    def add_many(self, mapping):
+        self.objects.update(mapping)
+
+
+def get_identity_map():
+    """
+    Returns the identity map of the current thread, or None when inactive
+    """
+    return getattr(_local, 'identity_map', None)
+
+
+def activate():
+    _local.identity_map = IdentityMap()
+    return _local.identity_map
+
+
+def deactivate():
+    _local.identity_map = None
+
+
+@contextmanager
+def scope():
+    """
+    Activates a fresh identity map for the duration of a ``with`` block,
+    for code running outside of a request.
+    """
+    previous = get_identity_map()
+    try:
+        yield activate()
+    finally:
+        _local.identity_map = previous
+
+
+def add_objects(objects):
+    """
+    Registers model instances in the active identity map
+    """
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        identity_map.add_many((cache_key(obj), obj) for obj in objects)
+
+
+def get_action(pk):
+    """
+    Returns the action with the given primary key, from the active identity
+    map when it was already loaded.
+    """
+    from actstream.models import Action
+
+    identity_map = get_identity_map()
+    if identity_map is None:
+        return Action.objects.get(pk=pk)
+    key = (ContentType.objects.get_for_model(Action).pk, smart_unicode(pk))
+    action = identity_map.get(key)
+    if action is None:
+        action = Action.objects.get(pk=pk)
+        identity_map.add_many([(key, action)])
+    return action
+
+
+def get_related(instance, field):
+    """
+    Returns the object of the generic foreign key ``field`` of ``instance``,
+    from the active identity map when it was already loaded.
+    """
+    gfk = [g for g in instance._meta.virtual_fields if g.name == field][0]
+    identity_map = get_identity_map()
+    if identity_map is None or hasattr(instance, gfk.cache_attr):
+        return getattr(instance, field)
+    content_type_id = getattr(
+        instance, instance._meta.get_field(gfk.ct_field).attname)
+    object_id = getattr(instance, gfk.fk_field)
+    if content_type_id is None or object_id is None:
+        return None
+    key = (content_type_id, smart_unicode(object_id))
+    obj = identity_map.get(key)
+    if obj is None:
+        obj = getattr(instance, field)
+        if obj is not None:
+            identity_map.add_many([(key, obj)])
+    else:
+        setattr(instance, gfk.cache_attr, obj)
+    return obj
@@ -0,0 +1,314 @@
+"""
+Buffered ingestion of actions.
+
+With ``ACTSTREAM_SETTINGS['INGESTION'] = 'buffered'`` the ``action`` signal
+handler only appends a payload describing the action to a local queue. A
+worker (``manage.py actstream_ingest``) drains the queue and writes the
+actions in batches with ``bulk_create``, applying the same-day deduplication
+of ``action.send``.
+
+Messages are reserved before being written and only removed from the queue
+once the batch is committed, so a crashing worker leaves them to be delivered
+again (at-least-once). Deduplication makes the redelivery harmless.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from actstream import settings
+
+PAYLOAD_FIELDS = ('actor_content_type_id', 'actor_object_id', 'verb',
+                  'target_content_type_id', 'target_object_id',
+                  'action_object_content_type_id', 'action_object_object_id',
+                  'public', 'description', 'batch_time_minutes',
+                  'is_batchable', 'site_id')
+
+
+def action_to_payload(action):
+    """
+    Returns a JSON serializable description of an unsaved action
+    """
+    payload = dict((name, getattr(action, name)) for name in PAYLOAD_FIELDS)
+    payload['timestamp'] = action.timestamp.isoformat()
+    if settings.USE_JSONFIELD and getattr(action, 'data', None):
+        payload['data'] = action.data
+    return payload
+
+
+def payload_to_action(payload):
+    """
+    Returns the unsaved action described by a payload
+    """
+    from actstream.models import Action, to_date
+
+    payload = dict(payload)
+    timestamp = parse_datetime(payload.pop('timestamp'))
+    data = payload.pop('data', None)
+    action = Action(timestamp=timestamp, timestamp_date=to_date(timestamp),
+                    **dict((str(name), value) for name, value in payload.items()))
+    if data:
+        action.data = data
+    return action
+
+
+class MemoryQueue(object):
+    """
+    Queue kept in the memory of the current process. Only useful when the
+    worker runs in the same process, eg. in tests. Reservations older than
+    ``visibility_timeout`` seconds are delivered again.
+    """
+
+    def __init__(self, visibility_timeout=300):
+        self.visibility_timeout = visibility_timeout
+        self._pending = deque()
+        self._reserved = {}
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def put(self, payload):
+        with self._lock:
+            self._counter += 1
+            self._pending.append((self._counter, time.time(), payload))
+
+    def _expire_reservations(self):
+        """
+        Puts the expired reservations back in the queue, in order. Must be
+        called with the lock held.
+        """
+        deadline = time.time() - self.visibility_timeout
+        expired = [message_id for message_id, (message, reserved)
+                   in self._reserved.items() if reserved < deadline]
+        if expired:
+            for message_id in expired:
+                self._pending.append(self._reserved.pop(message_id)[0])
+            self._pending = deque(sorted(self._pending))
+
+    def reserve(self, count):
+        """
+        Returns up to ``count`` ``(message_id, payload)`` tuples, oldest first.
+        """
+        with self._lock:
+            self._expire_reservations()
+            now = time.time()
+            messages = []
+            while self._pending and len(messages) < count:
+                message = self._pending.popleft()
+                self._reserved[message[0]] = (message, now)
+                messages.append((message[0], message[2]))
+            return messages
+
+    def ack(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                self._reserved.pop(message_id, None)
+
+    def release(self, message_ids):
+        """
+        Puts reserved messages back in front of the queue.
+        """
+        with self._lock:
+            for message_id in sorted(message_ids, reverse=True):
+                reservation = self._reserved.pop(message_id, None)
+                if reservation is not None:
+                    self._pending.appendleft(reservation[0])
+
+    def oldest_age(self):
+        with self._lock:
+            self._expire_reservations()
+            if not self._pending:
+                return None
+            return time.time() - self._pending[0][1]
+
+    def __len__(self):
+        with self._lock:
+            self._expire_reservations()
+            return len(self._pending)
+
+
+class SQLiteQueue(object):
+    """
+    Queue stored in a local SQLite database file, shared by the web processes
+    and the worker of one host. Reservations older than ``visibility_timeout``
+    seconds are delivered again.
+    """
+
+    def __init__(self, path, visibility_timeout=300):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self._local = threading.local()
+        self._execute('CREATE TABLE IF NOT EXISTS actstream_queue ('
+                      'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                      'enqueued REAL NOT NULL, reserved REAL, '
+                      'payload TEXT NOT NULL)')
+
+    @property
+    def connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = sqlite3.connect(self.path, timeout=30,
+                                                     isolation_level=None)
+        return self._local.connection
+
+    def _execute(self, sql, params=()):
+        return self.connection.execute(sql, params)
+
+    def put(self, payload):
+        self._execute('INSERT INTO actstream_queue (enqueued, payload) '
+                      'VALUES (?, ?)', (time.time(), json.dumps(payload)))
+
+    def reserve(self, count):
+        now = time.time()
+        self._execute('BEGIN IMMEDIATE')
+        try:
+            rows = self._execute(
+                'SELECT id, payload FROM actstream_queue WHERE reserved IS NULL '
+                'OR reserved < ? ORDER BY id LIMIT ?',
+                (self._deadline(), count)).fetchall()
+            if rows:
+                self._execute('UPDATE actstream_queue SET reserved = ? '
+                              'WHERE id IN (%s)' % ','.join('?' * len(rows)),
+                              [now] + [row[0] for row in rows])
+            self._execute('COMMIT')
+        except Exception:
+            self._execute('ROLLBACK')
+            raise
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def ack(self, message_ids):
+        if message_ids:
+            self._execute('DELETE FROM actstream_queue WHERE id IN (%s)' %
+                          ','.join('?' * len(message_ids)), list(message_ids))
+
+    def release(self, message_ids):
+        if message_ids:
+            self._execute('UPDATE actstream_queue SET reserved = NULL '
+                          'WHERE id IN (%s)' % ','.join('?' * len(message_ids)),
+                          list(message_ids))
+
+    def oldest_age(self):
+        oldest = self._execute('SELECT MIN(enqueued) FROM actstream_queue '
+                               'WHERE reserved IS NULL OR reserved < ?',
+                               (self._deadline(),)).fetchone()[0]
+        return None if oldest is None else time.time() - oldest
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM actstream_queue WHERE '
+                             'reserved IS NULL OR reserved < ?',
+                             (self._deadline(),)).fetchone()[0]
+
+    def _deadline(self):
+        """
+        Reservations made before this time have expired
+        """
+        return time.time() - self.visibility_timeout
+
+
+def sqlite_queue():
+    """
+    Returns the SQLite queue stored in ``QUEUE_PATH``, which must be absolute
+    for the web processes and the worker to share the same file whatever
+    their working directory.
+    """
+    if not settings.QUEUE_PATH or not os.path.isabs(settings.QUEUE_PATH):
+        raise ImproperlyConfigured('ACTSTREAM_SETTINGS["QUEUE_PATH"] must be '
+                                   'an absolute path to use the sqlite queue')
+    return SQLiteQueue(settings.QUEUE_PATH)
+
+
+BACKENDS = {
+    'memory': lambda: MemoryQueue(),
+    'sqlite': sqlite_queue,
+}
+
+_queue = None
+
+
+def is_buffered():
+    """
+    Returns True if actions are queued instead of written by the signal
+    handler
+    """
+    return settings.INGESTION == 'buffered'
+
+
+def get_queue():
+    """
+    Returns the configured ingestion queue
+    """
+    global _queue
+    if _queue is None:
+        _queue = BACKENDS[settings.QUEUE_BACKEND]()
+    return _queue
+
+
+def reset_queue():
+    """
+    Drops the configured queue so that it is rebuilt from the settings on the
+    next access.
+    """
+    global _queue
+    _queue = None
+
+
+def enqueue(action):
+    """
+    Appends an unsaved action to the ingestion queue
+    """
+    get_queue().put(action_to_payload(action))
+
+
+def should_flush(queue=None, batch_size=None, max_age=None):
+    """
+    Returns True once the queue holds a full batch or its oldest message is
+    older than ``max_age`` seconds.
+    """
+    queue = queue or get_queue()
+    batch_size = batch_size or settings.QUEUE_BATCH_SIZE
+    max_age = settings.QUEUE_MAX_AGE if max_age is None else max_age
+    if len(queue) >= batch_size:
+        return True
+    age = queue.oldest_age()
+    return age is not None and age >= max_age
+
+
+def flush(queue=None, batch_size=None):
+    """
+    Writes one batch of queued actions in one transaction and acknowledges
+    them once it is committed. Returns the number of messages processed.
+    """
+    from actstream.actions import save_actions
+
+    queue = queue or get_queue()
+    messages = queue.reserve(batch_size or settings.QUEUE_BATCH_SIZE)
+    if not messages:
+        return 0
+    message_ids = [message_id for message_id, payload in messages]
+    try:
+        # the whole batch is committed at once, and acknowledged once it is
+        with transaction.commit_on_success():
+            save_actions([payload_to_action(payload) for message_id, payload
+                          in messages])
+    except Exception:
+        queue.release(message_ids)
+        raise
+    queue.ack(message_ids)
+    return len(messages)
+
+
+def drain(queue=None, batch_size=None):
+    """
+    Flushes batches until the queue is empty. Returns the number of messages
+    processed.
+    """
+    total = 0
+    while True:
+        flushed = flush(queue, batch_size)
+        if not flushed:
+            return total
+        total += flushed
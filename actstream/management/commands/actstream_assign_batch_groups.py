@@ -0,0 +1,94 @@
+"""
+A management command which records ``Action.batch_group`` for the actions
+written before batch groups were assigned at write time (see the
+``BATCH_GROUPS`` setting).
+
+The published actions are replayed oldest first, the way ``action.send``
+groups them, keeping only the batches that can still grow in memory.
+
+"""
+from collections import defaultdict, deque, OrderedDict
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from actstream.batching import ACTIVITY_DEFAULT_BATCH_TIME, group_key
+from actstream.models import Action
+
+
+class Command(BaseCommand):
+    help = "Assign the batch groups of the existing actions"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Number of actions updated per transaction'),
+    )
+
+    def handle(self, **options):
+        self.batch_size = options['batch_size']
+        follow_verb = settings.FOLLOW_VERB
+        max_window = timedelta(minutes=max(
+            Action.objects.aggregate(Max('batch_time_minutes'))
+            ['batch_time_minutes__max'] or 0, ACTIVITY_DEFAULT_BATCH_TIME))
+        Action.objects.filter(batch_group__isnull=False).update(
+            batch_group=None)
+
+        rows = Action.objects.public().order_by('timestamp', 'id').values_list(
+            'id', 'timestamp', 'verb', 'actor_content_type', 'actor_object_id',
+            'target_content_type', 'target_object_id', 'site',
+            'is_batchable', 'batch_time_minutes')
+
+        # head id -> (head timestamp, member ids) of the batches still open
+        self.groups, self.pending, self.updated = OrderedDict(), [], 0
+        group_of, recent = {}, defaultdict(deque)
+        for row in rows.iterator():
+            pk, timestamp, verb = row[:3]
+            site_id, is_batchable, minutes = row[7:]
+            self.close_groups(group_of, timestamp - max_window)
+            if verb != follow_verb and row[6] is None:
+                continue
+            members = recent[(site_id,) + group_key(*(row[2:7] + (follow_verb,)))]
+            while members and members[0][0] < timestamp - max_window:
+                members.popleft()
+            if is_batchable:
+                cutoff = timestamp - timedelta(
+                    minutes=minutes or ACTIVITY_DEFAULT_BATCH_TIME)
+                heads = set(group_of.get(member, member) for member_timestamp,
+                            member in members if member_timestamp >= cutoff)
+                if heads:
+                    ids = [pk]
+                    for head in heads:
+                        ids.extend(self.groups.pop(head, (None, [head]))[1])
+                    self.groups[pk] = (timestamp, ids)
+                    for member in ids:
+                        group_of[member] = pk
+            members.append((timestamp, pk))
+        self.close_groups(group_of)
+        self.write()
+        self.stdout.write('Assigned %d actions to batch groups\n' % self.updated)
+
+    def close_groups(self, group_of, before=None):
+        """
+        Queues the batches whose head is older than ``before``, which no
+        later action can extend anymore.
+        """
+        while self.groups:
+            head, (timestamp, ids) = next(self.groups.iteritems())
+            if before is not None and timestamp >= before:
+                break
+            del self.groups[head]
+            for member in ids:
+                group_of.pop(member, None)
+            self.pending.append((head, ids))
+            if sum(len(ids) for head, ids in self.pending) >= self.batch_size:
+                self.write()
+
+    def write(self):
+        with transaction.commit_on_success():
+            for head, ids in self.pending:
+                Action.objects.filter(id__in=ids).update(batch_group=head)
+        self.updated += sum(len(ids) for head, ids in self.pending)
+        self.pending = []
@@ -0,0 +1,37 @@
+"""
+A management command which materializes the ``user`` stream of existing
+follows into ``InboxEntry`` rows.
+
+Run it once after adding ``'user'`` to ``ACTSTREAM_SETTINGS['FANOUT_ON_WRITE']``
+so that actions saved before fan-out-on-write was enabled show up in the
+users' streams.
+
+"""
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from actstream import fanout
+
+
+class Command(BaseCommand):
+    help = "Backfill the materialized user stream inboxes from the Follow table"
+    args = '[username ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help='Number of inbox entries inserted per query'),
+    )
+
+    def handle(self, *usernames, **options):
+        users = User.objects.filter(follow__isnull=False).distinct()
+        if usernames:
+            users = users.filter(username__in=usernames)
+        total = 0
+        for user in users.iterator():
+            created = fanout.backfill_user(user,
+                                           batch_size=options['batch_size'])
+            total += created
+            if int(options.get('verbosity', 1)) > 1:
+                self.stdout.write('%s: %d entries\n' % (user, created))
+        self.stdout.write('Created %d inbox entries\n' % total)
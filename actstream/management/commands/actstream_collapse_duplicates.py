@@ -0,0 +1,74 @@
+"""
+A management command which collapses the duplicate published actions that
+``action.send`` used to leave behind and assigns ``Action.dedup_key`` to the
+survivors.
+
+Run it once after migrating to the ``dedup_key`` column; from then on the
+unique key keeps a single published action per actor, verb, target, action
+object, day and site.
+
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from actstream.models import Action, DEDUP_FIELDS, make_dedup_key
+
+
+class Command(BaseCommand):
+    help = "Collapse same-day duplicate actions and assign their dedup keys"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Number of actions deleted or updated per transaction'),
+    )
+
+    def handle(self, **options):
+        batch_size = options['batch_size']
+        rows = Action.objects.filter(state=1).order_by(
+            'timestamp_date', '-id').values_list(
+            'id', 'timestamp', 'dedup_key', *DEDUP_FIELDS)
+
+        # actions are scanned one day at a time, so only the keys of the
+        # current day are kept in memory
+        duplicates, keep, day = [], {}, None
+        deleted = updated = 0
+        for row in rows.iterator():
+            pk, timestamp, current_key, values = row[0], row[1], row[2], row[3:]
+            if values[DEDUP_FIELDS.index('timestamp_date')] != day:
+                # duplicates go first, they may hold the key of a survivor
+                deleted += self.delete(duplicates)
+                updated += self.assign_keys(keep, batch_size)
+                duplicates, keep = [], {}
+                day = values[DEDUP_FIELDS.index('timestamp_date')]
+            key = make_dedup_key(values)
+            if key in keep:
+                # the highest id of the day survives with the latest timestamp
+                duplicates.append(pk)
+                keep[key][2] = max(keep[key][2], timestamp)
+                keep[key][3] = True
+            else:
+                keep[key] = [pk, current_key, timestamp, current_key != key]
+            if len(duplicates) >= batch_size:
+                deleted += self.delete(duplicates)
+                duplicates = []
+        deleted += self.delete(duplicates)
+        updated += self.assign_keys(keep, batch_size)
+        self.stdout.write('Deleted %d duplicate actions, updated %d actions\n'
+                          % (deleted, updated))
+
+    def delete(self, ids):
+        if ids:
+            with transaction.commit_on_success():
+                Action.objects.filter(id__in=ids).delete()
+        return len(ids)
+
+    def assign_keys(self, keep, batch_size):
+        changed = [(key, pk, timestamp) for key, (pk, current_key, timestamp,
+                   dirty) in keep.items() if dirty]
+        for start in range(0, len(changed), batch_size):
+            with transaction.commit_on_success():
+                for key, pk, timestamp in changed[start:start + batch_size]:
+                    Action.objects.filter(id=pk).update(dedup_key=key,
+                                                        timestamp=timestamp)
+        return len(changed)
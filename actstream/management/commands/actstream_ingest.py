@@ -0,0 +1,44 @@
+"""
+A management command which runs the worker writing the actions queued by the
+``action`` signal handler when ``ACTSTREAM_SETTINGS['INGESTION']`` is
+``'buffered'``.
+
+A batch is written as soon as ``QUEUE_BATCH_SIZE`` actions are waiting or the
+oldest one has waited ``QUEUE_MAX_AGE`` seconds.
+
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from actstream import ingestion, settings
+
+
+class Command(BaseCommand):
+    help = "Write the queued actions to the database in batches"
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Drain the queue once and exit'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=settings.QUEUE_BATCH_SIZE,
+            help='Maximum number of actions written per batch'),
+        make_option('--max-age', dest='max_age', type='float',
+            default=settings.QUEUE_MAX_AGE,
+            help='Seconds an action may wait before a partial batch is written'),
+        make_option('--interval', dest='interval', type='float', default=0.5,
+            help='Seconds to sleep between checks of the queue'),
+    )
+
+    def handle(self, **options):
+        batch_size = options['batch_size']
+        if options['once']:
+            count = ingestion.drain(batch_size=batch_size)
+            self.stdout.write('Wrote %d queued actions\n' % count)
+            return
+        while True:
+            if ingestion.should_flush(batch_size=batch_size,
+                                      max_age=options['max_age']):
+                ingestion.flush(batch_size=batch_size)
+            else:
+                time.sleep(options['interval'])
@@ -0,0 +1,74 @@
+"""
+A management command which recomputes the denormalized ``FollowCount`` rows
+of the current site from the ``Follow`` table, fixing the counts that drifted
+(follows written or deleted without ``follow``/``unfollow``).
+
+Counts missing altogether are computed the first time they are read.
+
+"""
+from collections import defaultdict
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
+
+from actstream.models import Follow, FollowCount
+
+
+class Command(BaseCommand):
+    help = "Recompute the follower and following counts"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Number of counts recomputed per transaction'),
+    )
+
+    def handle(self, **options):
+        batch_size = options['batch_size']
+        counts = FollowCount.objects.filter(site=settings.SITE_ID).order_by(
+            'pk')
+        last_pk, fixed = 0, 0
+        while True:
+            batch = list(counts.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            fixed += self.reconcile(batch)
+        self.stdout.write('Fixed %d follow counts\n' % fixed)
+
+    def reconcile(self, batch):
+        follows = Follow.objects.filter(site=settings.SITE_ID).order_by()
+        user_content_type = ContentType.objects.get_for_model(User).pk
+        ids_by_content_type = defaultdict(list)
+        for counts in batch:
+            ids_by_content_type[counts.content_type_id].append(counts.object_id)
+
+        followers, following = {}, {}
+        for content_type_id, object_ids in ids_by_content_type.items():
+            for object_id, count in follows.filter(
+                    content_type=content_type_id,
+                    object_id__in=object_ids).values_list(
+                    'object_id').annotate(Count('id')):
+                followers[(content_type_id, object_id)] = count
+        for user_id, count in follows.filter(
+                user__in=ids_by_content_type.get(user_content_type, ())
+                ).values_list('user').annotate(Count('id')):
+            following[smart_unicode(user_id)] = count
+
+        fixed = 0
+        with transaction.commit_on_success():
+            for counts in batch:
+                actual = (
+                    followers.get((counts.content_type_id, counts.object_id), 0),
+                    following.get(counts.object_id, 0)
+                    if counts.content_type_id == user_content_type else 0,
+                )
+                if actual != (counts.followers_count, counts.following_count):
+                    FollowCount.objects.filter(pk=counts.pk).update(
+                        followers_count=actual[0], following_count=actual[1])
+                    fixed += 1
+        return fixed
@@ -1,14 +1,28 @@
 from collections import defaultdict
 
+from django.db import IntegrityError, connection, transaction
 from django.db.models import get_model
-from django.db.models import Q
+from django.db.models import F, Manager, Q, Count
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
+from django.utils.encoding import smart_unicode
 
-from actstream.gfk import GFKManager
+from actstream import fanout, follow_cache
+from actstream.gfk import GFKManager, attach_generic_relations
 from actstream.decorators import stream
 
 
+def _column(model, name):
+    """
+    Returns the quoted, table qualified column of a model field, for the
+    clauses written in SQL
+    """
+    qn = connection.ops.quote_name
+    return '%s.%s' % (qn(model._meta.db_table),
+                      qn(model._meta.get_field(name).column))
+
+
 class ActionManager(GFKManager):
     """
     Default manager for Actions, accessed through Action.objects
@@ -73,10 +87,28 @@ class ActionManager(GFKManager):
         """
         Stream of most recent actions by objects that the passed User object is
         following.
+
+        When ``'user'`` is listed in ``ACTSTREAM_SETTINGS['FANOUT_ON_WRITE']``
+        the stream is read from the user's materialized inbox instead of being
+        rebuilt from their follows on every call.
+        """
+        if fanout.is_enabled('user'):
+            return self.public(
+                inbox_entries__user=object,
+                site_id=settings.SITE_ID,
+                **kwargs
+            ).order_by('-inbox_entries__timestamp')
+        return self.followed_actions(object).filter(
+            public=True, state=1, **kwargs)
+
+    def followed_actions(self, object):
+        """
+        Returns all actions (regardless of their visibility) of the objects the
+        passed User object is following, computed from the ``Follow`` table.
         """
         q = Q()
         q_ex = Q()
-        qs = self.filter(public=True, state=1)
+        qs = self.all()
         actors_by_content_type = defaultdict(lambda: [])
         others_by_content_type = defaultdict(lambda: [])
 
@@ -122,10 +154,82 @@ class ActionManager(GFKManager):
             actor_object_id=object.id,
         )
 
-        qs = qs.filter(q, **kwargs).exclude(q_ex)
+        qs = qs.filter(q).exclude(q_ex)
         qs = qs.filter(site_id=settings.SITE_ID)
         return qs
 
+    def _follow_exists(self, user, field, **follow_kwargs):
+        """
+        Returns the SQL and parameters of a correlated ``EXISTS`` clause
+        matching the actions whose ``field`` (``actor``, ``target`` or
+        ``action_object``) the passed User object has followed since the
+        action was done. ``follow_kwargs`` (e.g. ``actor_only``) narrow the
+        follows considered.
+        """
+        follow = get_model('actstream', 'follow')
+        conditions = [
+            '%s = %s' % (_column(follow, 'content_type'),
+                         _column(self.model, '%s_content_type' % field)),
+            '%s = %s' % (_column(follow, 'object_id'),
+                         _column(self.model, '%s_object_id' % field)),
+            '%s <= %s' % (_column(follow, 'started'),
+                          _column(self.model, 'timestamp')),
+        ]
+        params = []
+        for name, value in sorted(dict(follow_kwargs, user=user.pk).items()):
+            conditions.append('%s = %%s' % _column(follow, name))
+            params.append(value)
+        return 'EXISTS (SELECT 1 FROM %s WHERE %s)' % (
+            connection.ops.quote_name(follow._meta.db_table),
+            ' AND '.join(conditions)), params
+
+    def followed_since(self, user, **kwargs):
+        """
+        Public actions of the actors the passed User object is following,
+        done since they were followed. Follows are matched with a correlated
+        ``EXISTS`` on the follow table, so the query has the same size however
+        many actors are followed.
+        """
+        exists, params = self._follow_exists(user, 'actor')
+        return self.public(**kwargs).extra(where=[exists], params=params)
+
+    def followed_actions_since(self, object):
+        """
+        Same actions as ``followed_actions``, limited to the ones done since
+        the followed object was followed, and matched in SQL with correlated
+        ``EXISTS`` clauses on the follow table instead of lists of followed
+        ids built in Python.
+        """
+        clauses = [self._follow_exists(object, 'actor')] + [
+            self._follow_exists(object, field, actor_only=False)
+            for field in ('target', 'action_object')]
+        viewed, viewed_params = clauses[1]
+        return self.extra(
+            where=[
+                '(%s)' % ' OR '.join(sql for sql, params in clauses),
+                # actions viewing a followed target are not news
+                'NOT (%s LIKE %%s AND %s)' % (
+                    _column(self.model, 'verb'), viewed),
+            ],
+            params=sum([params for sql, params in clauses], []) +
+                ['viewed%'] + viewed_params,
+        ).exclude(
+            actor_content_type=ContentType.objects.get_for_model(
+                object.__class__),
+            actor_object_id=object.pk,
+        ).filter(site_id=settings.SITE_ID)
+
+    @stream
+    def user_since(self, object, **kwargs):
+        """
+        Variant of the ``user`` stream reading ``followed_actions_since``:
+        the actions of the objects the passed User object follows, done since
+        they were followed, selected by the database without loading the
+        follows.
+        """
+        return self.followed_actions_since(object).filter(
+            public=True, state=1, **kwargs)
+
     def get_broadcasters(self, object):
         ctype = ContentType.objects.get_for_model(object)
         result = self.filter(verb=settings.SHARE_VERB, target_content_type=ctype, target_object_id = object._get_pk_val())
@@ -138,6 +242,110 @@ class ActionManager(GFKManager):
             'users':broadcasters,
         }
 
+    def preload_shares(self, actions, user=None, verb=None):
+        """
+        Attaches ``share_count`` and, when a user is given, ``can_share`` to
+        every action of a feed page with one grouped query each, instead of
+        the two ``COUNT(*)`` per action run by the ``get_share_count`` and
+        ``can_share_action`` tags. Returns the actions as a list.
+        """
+        actions = list(actions)
+        if not actions:
+            return actions
+        verb = verb or settings.SHARE_VERB
+        shares = self.filter(
+            verb=verb,
+            target_content_type=ContentType.objects.get_for_model(self.model),
+            target_object_id__in=[smart_unicode(a.pk) for a in actions])
+
+        counts = dict(shares.values_list('target_object_id').order_by()
+                      .annotate(count=Count('id')))
+        for action in actions:
+            action.share_count = counts.get(smart_unicode(action.pk), 0)
+
+        if user is not None and not user.is_anonymous():
+            user_ctype = ContentType.objects.get_for_model(user)
+            user_key = (user_ctype.pk, smart_unicode(user.pk))
+            shared = set(shares.filter(
+                actor_content_type=user_ctype,
+                actor_object_id=user.pk,
+            ).values_list('target_object_id', flat=True))
+            for action in actions:
+                action.can_share = not (
+                    smart_unicode(action.pk) in shared or action.verb == verb
+                    or (action.actor_content_type_id,
+                        smart_unicode(action.actor_object_id)) == user_key)
+        return actions
+
+
+class FollowSequence(object):
+    """
+    Lazy, sliceable sequence of the objects of a ``Follow`` queryset, in
+    follow order. Slices load just their follows; iteration pages through
+    them by follow id. ``resolve`` maps a page of follows to its objects in
+    bulk.
+    """
+
+    def __init__(self, queryset, resolve, count=None, page_size=100):
+        self.queryset = queryset.order_by('id')
+        self.resolve = resolve
+        self.page_size = page_size
+        self._count = count
+
+    def count(self):
+        if self._count is None:
+            self._count = self.queryset.count()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step is not None:
+                raise ValueError('FollowSequence does not support steps')
+            start, stop = index.start, index.stop
+            if (start or 0) < 0 or (stop or 0) < 0:
+                # the database can not count from the end
+                start, stop, step = index.indices(self.count())
+            if start is not None and stop is not None and stop <= start:
+                return []
+            return self.resolve(list(self.queryset[start:stop]))
+        if not isinstance(index, (int, long)):
+            raise TypeError('FollowSequence indices must be integers or '
+                            'slices, not %s' % type(index).__name__)
+        if index < 0:
+            index += self.count()
+            if index < 0:
+                raise IndexError('FollowSequence index out of range')
+        objects = self[index:index + 1]
+        if not objects:
+            raise IndexError('FollowSequence index out of range')
+        return objects[0]
+
+    def page(self, after=None, limit=None):
+        """
+        Returns the objects of up to ``limit`` follows with an id greater
+        than ``after``, and the id to pass as ``after`` for the next page
+        (None on the last one).
+        """
+        limit = limit or self.page_size
+        qs = self.queryset
+        if after is not None:
+            qs = qs.filter(id__gt=after)
+        follows = list(qs[:limit + 1])
+        next_after = follows[limit - 1].pk if len(follows) > limit else None
+        return self.resolve(follows[:limit]), next_after
+
+    def __iter__(self):
+        after = None
+        while True:
+            objects, after = self.page(after)
+            for obj in objects:
+                yield obj
+            if after is None:
+                return
+
 
 class FollowManager(GFKManager):
     """
@@ -157,8 +365,25 @@ class FollowManager(GFKManager):
         """
         if not user or user.is_anonymous():
             return False
-        queryset = self.for_object(instance)
-        return queryset.filter(user=user, site_id=settings.SITE_ID).exists()
+        return follow_cache.is_following(user, instance)
+
+    def followers_count(self, actor):
+        """
+        Returns the number of users following the given actor, read from its
+        denormalized ``FollowCount``.
+        """
+        return get_model('actstream', 'followcount').objects.for_object(
+            ContentType.objects.get_for_model(actor).pk, actor.pk
+        ).followers_count
+
+    def following_count(self, user):
+        """
+        Returns the number of objects the given user is following, read from
+        its denormalized ``FollowCount``.
+        """
+        return get_model('actstream', 'followcount').objects.for_object(
+            ContentType.objects.get_for_model(user).pk, user.pk
+        ).following_count
 
     def followers(self, actor):
         """
@@ -170,6 +395,38 @@ class FollowManager(GFKManager):
             site_id=settings.SITE_ID
         ).select_related('user')]
 
+    def lazy_followers(self, actor, page_size=100):
+        """
+        Returns the users following the given actor as a lazy
+        ``FollowSequence``, for actors with too many followers to list at
+        once. Its length is the denormalized followers count.
+        """
+        return FollowSequence(
+            self.for_object(actor).filter(site_id=settings.SITE_ID)
+                .select_related('user'),
+            lambda follows: [follow.user for follow in follows],
+            count=self.followers_count(actor), page_size=page_size)
+
+    def lazy_following(self, user, *models, **kwargs):
+        """
+        Returns the actors the given user is following on the current site
+        as a lazy ``FollowSequence``, fetching the actors of each page with
+        one query per model. Accepts the same models as ``following``.
+        """
+        qs = self.filter(user=user, site_id=settings.SITE_ID)
+        count = None
+        if len(models):
+            qs = qs.filter(content_type__in=(
+                ContentType.objects.get_for_model(model) for model in models)
+            )
+        else:
+            count = self.following_count(user)
+        return FollowSequence(
+            qs,
+            lambda follows: [follow.follow_object for follow in
+                             attach_generic_relations(follows, using=self.db)],
+            count=count, page_size=kwargs.get('page_size', 100))
+
     def following(self, user, *models):
         """
         Returns a list of actors that the given user is following (eg who im following).
@@ -182,3 +439,75 @@ class FollowManager(GFKManager):
                 ContentType.objects.get_for_model(model) for model in models)
             )
         return [follow.follow_object for follow in qs.fetch_generic_relations()]
+
+
+class FollowCountManager(Manager):
+    """
+    Manager for the FollowCount model.
+    """
+
+    def compute(self, content_type_id, object_id):
+        """
+        Counts the follows of an object, and the objects it follows when it
+        is a user, in the ``Follow`` table.
+        Returns a ``(followers_count, following_count)`` tuple.
+        """
+        follows = get_model('actstream', 'follow').objects.filter(
+            site=settings.SITE_ID)
+        following = 0
+        if content_type_id == ContentType.objects.get_for_model(User).pk:
+            following = follows.filter(user=object_id).count()
+        return follows.filter(content_type=content_type_id,
+                              object_id=object_id).count(), following
+
+    def _lookup(self, content_type_id, object_id):
+        return dict(content_type_id=content_type_id, site_id=settings.SITE_ID,
+                    object_id=smart_unicode(object_id))
+
+    def _create(self, content_type_id, object_id):
+        """
+        Creates the counts of an object from the ``Follow`` table. Returns
+        None when they were created concurrently.
+        """
+        followers, following = self.compute(content_type_id, object_id)
+        sid = transaction.savepoint()
+        try:
+            counts = self.create(followers_count=followers,
+                                 following_count=following,
+                                 **self._lookup(content_type_id, object_id))
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return None
+        transaction.savepoint_commit(sid)
+        return counts
+
+    def for_object(self, content_type_id, object_id):
+        """
+        Returns the counts of an object, computing them from the ``Follow``
+        table the first time they are needed.
+        """
+        lookup = self._lookup(content_type_id, object_id)
+        try:
+            return self.get(**lookup)
+        except self.model.DoesNotExist:
+            pass
+        return self._create(content_type_id, object_id) or self.get(**lookup)
+
+    def adjust(self, content_type_id, object_ids, field, delta):
+        """
+        Atomically adds ``delta`` to the ``field`` count of the given objects.
+        Missing counts are computed from the ``Follow`` table instead, which
+        already holds the change, unless they are created concurrently: the
+        delta is then added to the created counts.
+        """
+        object_ids = set(smart_unicode(object_id) for object_id in object_ids)
+        counts = self.filter(content_type=content_type_id,
+                             site=settings.SITE_ID)
+        existing = set(counts.filter(object_id__in=object_ids)
+                       .values_list('object_id', flat=True))
+        created = set(object_id for object_id in object_ids - existing
+                      if self._create(content_type_id, object_id))
+        updated = object_ids - created
+        if updated:
+            counts.filter(object_id__in=updated).update(
+                **{field: F(field) + delta})
@@ -0,0 +1,25 @@
+from django.conf import settings
+
+from actstream import identity_map
+
+
+class IdentityMapMiddleware(object):
+    """
+    Scopes an identity map of actions and their related objects to every
+    request. With ``DEBUG`` on, its hits and misses are reported in the
+    ``X-Actstream-Identity-Map`` response header.
+    """
+
+    def process_request(self, request):
+        identity_map.activate()
+
+    def process_response(self, request, response):
+        current = identity_map.get_identity_map()
+        if current is not None and settings.DEBUG:
+            response['X-Actstream-Identity-Map'] = 'hits=%d; misses=%d' % (
+                current.hits, current.misses)
+        identity_map.deactivate()
+        return response
+
+    def process_exception(self, request, exception):
+        identity_map.deactivate()
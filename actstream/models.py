@@ -1,4 +1,8 @@
+import datetime
+import hashlib
+
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.conf import settings
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
@@ -6,20 +10,24 @@ from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext as _
 
+from follow.models import Follow as _Follow
+
 
 try:
     from django.utils import timezone
     now = timezone.now
 except ImportError:
-    from datetime import datetime
-    now = datetime.now
+    timezone = None
+    now = datetime.datetime.now
 
-from actstream import settings as actstream_settings
+from actstream import feed_plan, follow_cache, object_cache, stream_cache,\
+    watermark, settings as actstream_settings
 from actstream.signals import action
 from actstream.actions import action_handler
-from actstream.managers import FollowManager
+from actstream.managers import FollowManager, FollowCountManager
 
 
 STATE_TYPES = (
@@ -27,6 +35,33 @@ STATE_TYPES = (
     (1, u'Published'),
 )
 
+# fields identifying the published actions of a day that are collapsed into one
+DEDUP_FIELDS = ('actor_content_type', 'actor_object_id', 'verb',
+                'target_content_type', 'target_object_id',
+                'action_object_content_type', 'action_object_object_id',
+                'timestamp_date', 'site')
+
+
+def to_date(value):
+    """
+    Returns the date of a datetime as stored in a ``DateField``
+    """
+    if isinstance(value, datetime.datetime):
+        if getattr(settings, 'USE_TZ', False) and timezone.is_aware(value):
+            value = timezone.localtime(value)
+        return value.date()
+    return value
+
+
+def make_dedup_key(values):
+    """
+    Hashes the values of ``DEDUP_FIELDS`` into an ``Action.dedup_key``
+    """
+    values = [to_date(value) for value in values]
+    return hashlib.sha1(u'|'.join([
+        u'' if value is None else smart_unicode(value) for value in values
+    ]).encode('utf-8')).hexdigest()
+
 
 class Follow(models.Model):
     """
@@ -63,6 +98,39 @@ class Follow(models.Model):
         return u'%s -> %s' % (self.user, self.follow_object)
 
 
+class FollowCount(models.Model):
+    """
+    Denormalized number of followers of an object, and of objects followed by
+    it when it is a user, kept up to date by ``follow`` and ``unfollow``.
+    """
+    content_type = models.ForeignKey(
+        ContentType,
+        related_name='follow_counts'
+    )
+    object_id = models.CharField(
+        max_length=255
+    )
+    site = models.ForeignKey(
+        Site,
+        related_name='follow_counts',
+        default=settings.SITE_ID
+    )
+    followers_count = models.IntegerField(
+        default=0
+    )
+    following_count = models.IntegerField(
+        default=0
+    )
+    objects = FollowCountManager()
+
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'site')
+
+    def __unicode__(self):
+        return u'%s followers, %s following' % (self.followers_count,
+                                               self.following_count)
+
+
 class Action(models.Model):
     """
     Action model describing the actor acting out a verb (on an optional
@@ -165,6 +233,14 @@ class Action(models.Model):
         default=False
     )
 
+    # id of the newest batchable action of the batch the action belongs to
+    batch_group = models.IntegerField(
+        null=True,
+        blank=True,
+        db_index=True,
+        editable=False
+    )
+
     state = models.SmallIntegerField(
         verbose_name=_('Publish state'),
         choices=STATE_TYPES,
@@ -177,10 +253,41 @@ class Action(models.Model):
         verbose_name='site'
     )
 
+    dedup_key = models.CharField(
+        max_length=40,
+        unique=True,
+        null=True,
+        blank=True,
+        editable=False
+    )
+
     objects = actstream_settings.get_action_manager()
 
     class Meta:
         ordering = ('-timestamp', )
+        index_together = (
+            # actor, target and action object streams, newest first
+            ('actor_content_type', 'actor_object_id', 'timestamp'),
+            ('target_content_type', 'target_object_id', 'timestamp'),
+            ('action_object_content_type', 'action_object_object_id',
+             'timestamp'),
+            # share counts of an action
+            ('target_content_type', 'target_object_id', 'verb'),
+        )
+
+    def save(self, *args, **kwargs):
+        # only published actions take part in deduplication
+        if self.state != 1:
+            self.dedup_key = None
+        super(Action, self).save(*args, **kwargs)
+
+    def get_dedup_key(self):
+        """
+        Returns the key shared by the published actions of the same actor,
+        verb, target, action object, day and site.
+        """
+        return make_dedup_key([getattr(self, self._meta.get_field(name).attname)
+                               for name in DEDUP_FIELDS])
 
     def __unicode__(self):
         ctx = {
@@ -232,6 +339,33 @@ class Action(models.Model):
         return ('actstream.views.detail', [self.pk])
 
 
+class InboxEntry(models.Model):
+    """
+    An action materialized into the ``user`` stream of one of its followers.
+    Only written for streams configured in
+    ``ACTSTREAM_SETTINGS['FANOUT_ON_WRITE']``.
+    """
+    user = models.ForeignKey(
+        User,
+        related_name='actstream_inbox'
+    )
+    action = models.ForeignKey(
+        Action,
+        related_name='inbox_entries'
+    )
+    timestamp = models.DateTimeField(
+        default=now
+    )
+
+    class Meta:
+        ordering = ('-timestamp', )
+        unique_together = ('user', 'action')
+        index_together = (('user', 'timestamp'), )
+
+    def __unicode__(self):
+        return u'%s <- %s' % (self.user, self.action_id)
+
+
 # convenient accessors
 actor_stream = Action.objects.actor
 actor_stream_private = Action.objects.actor_private
@@ -241,6 +375,10 @@ user_stream = Action.objects.user
 model_stream = Action.objects.model_actions
 followers = Follow.objects.followers
 following = Follow.objects.following
+lazy_followers = Follow.objects.lazy_followers
+lazy_following = Follow.objects.lazy_following
+followers_count = Follow.objects.followers_count
+following_count = Follow.objects.following_count
 
 def setup_generic_relations():
     """
@@ -263,6 +401,25 @@ def setup_generic_relations():
 
 
 setup_generic_relations()
+object_cache.connect_signals()
+post_save.connect(follow_cache.invalidate_follow, sender=Follow,
+                  dispatch_uid='actstream.follow_cache')
+post_delete.connect(follow_cache.invalidate_follow, sender=Follow,
+                    dispatch_uid='actstream.follow_cache')
+post_save.connect(feed_plan.invalidate_follow, sender=Follow,
+                  dispatch_uid='actstream.feed_plan')
+post_delete.connect(feed_plan.invalidate_follow, sender=Follow,
+                    dispatch_uid='actstream.feed_plan')
+post_save.connect(feed_plan.invalidate_follow, sender=_Follow,
+                  dispatch_uid='actstream.feed_plan')
+post_delete.connect(feed_plan.invalidate_follow, sender=_Follow,
+                    dispatch_uid='actstream.feed_plan')
+post_save.connect(stream_cache.action_saved, sender=Action,
+                  dispatch_uid='actstream.stream_cache')
+post_delete.connect(stream_cache.action_saved, sender=Action,
+                    dispatch_uid='actstream.stream_cache')
+post_save.connect(watermark.action_saved, sender=Action,
+                  dispatch_uid='actstream.watermark')
 
 
 if actstream_settings.USE_JSONFIELD:
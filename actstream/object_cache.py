@@ -0,0 +1,153 @@
+"""
+Process-wide cache of the objects that generic foreign keys point at.
+
+Hot actors and targets (popular users, companies, the ``Site``) are fetched
+for nearly every stream. When ``ACTSTREAM_SETTINGS['GFK_CACHE']`` is set,
+``GFKQuerySet.fetch_generic_relations`` looks them up here by
+``(content_type_id, object_pk)`` before issuing its ``pk__in`` queries.
+Entries are dropped when the cached model instances are saved or deleted.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.db.models.signals import post_save, post_delete
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
+
+from actstream import cache_keys, settings
+
+
+class MemoryObjectCache(object):
+    """
+    LRU cache of objects kept in the memory of the current process, expiring
+    entries after ``timeout`` seconds.
+    """
+
+    def __init__(self, size=1000, timeout=300):
+        self.size = size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found, now = {}, time.time()
+        with self._lock:
+            for key in keys:
+                try:
+                    expires, value = self._data.pop(key)
+                except KeyError:
+                    continue
+                if expires > now:
+                    # re-insert to mark it as the most recently used
+                    self._data[key] = (expires, value)
+                    found[key] = value
+        return found
+
+    def set_many(self, mapping):
+        expires = time.time() + self.timeout
+        with self._lock:
+            for key, value in mapping.items():
+                self._data.pop(key, None)
+                self._data[key] = (expires, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoObjectCache(object):
+    """
+    Object cache backed by one of the caches of Django's cache framework, so
+    it can be shared between processes.
+    """
+    def __init__(self, alias='default', timeout=300):
+        from django.core.cache import get_cache
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+
+    def make_key(self, key):
+        return cache_keys.make_key('object', key[0], key[1])
+
+    def get_many(self, keys):
+        keys = dict((self.make_key(key), key) for key in keys)
+        return dict((keys[cache_key], value) for cache_key, value in
+                    self.cache.get_many(keys.keys()).items())
+
+    def set_many(self, mapping):
+        self.cache.set_many(dict((self.make_key(key), value) for key, value
+                                 in mapping.items()), self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.make_key(key))
+
+    def clear(self):
+        """
+        Django caches can not be cleared per prefix, entries expire instead.
+        """
+
+
+BACKENDS = {
+    'memory': lambda: MemoryObjectCache(size=settings.GFK_CACHE_SIZE,
+                                        timeout=settings.GFK_CACHE_TIMEOUT),
+    'django': lambda: DjangoObjectCache(alias=settings.GFK_CACHE_ALIAS,
+                                        timeout=settings.GFK_CACHE_TIMEOUT),
+}
+
+_object_cache = None
+
+
+def get_object_cache():
+    """
+    Returns the configured object cache, or None when ``GFK_CACHE`` is unset.
+    """
+    global _object_cache
+    if not settings.GFK_CACHE:
+        return None
+    if _object_cache is None:
+        _object_cache = BACKENDS[settings.GFK_CACHE]()
+    return _object_cache
+
+
+def reset_object_cache():
+    """
+    Drops the configured object cache so that it is rebuilt from the settings
+    on the next access.
+    """
+    global _object_cache
+    if _object_cache is not None:
+        _object_cache.clear()
+    _object_cache = None
+
+
+def cache_key(instance):
+    return (ContentType.objects.get_for_model(instance).pk,
+            smart_unicode(instance.pk))
+
+
+def invalidate(sender, instance, **kwargs):
+    """
+    Signal handler removing a saved or deleted instance from the cache.
+    """
+    object_cache = get_object_cache()
+    if object_cache is not None:
+        object_cache.delete(cache_key(instance))
+
+
+def connect_signals():
+    """
+    Invalidates the cache entries of the actionable models when they change.
+    """
+    for model in settings.get_models().values():
+        if not model:
+            continue
+        uid = 'actstream.object_cache.%s.%s' % (model._meta.app_label,
+                                                model._meta.module_name)
+        post_save.connect(invalidate, sender=model, dispatch_uid=uid)
+        post_delete.connect(invalidate, sender=model, dispatch_uid=uid)
@@ -0,0 +1,178 @@
+"""
+Publication of new actions to the users whose feed they enter.
+
+With ``ACTSTREAM_SETTINGS['PUBSUB_BACKEND']`` set, the id of every action
+saved by ``action_handler`` or ``save_actions`` is published on the channel of
+each user whose following feed it enters (see ``views.feed_follower_ids``).
+The ``actstream_events`` view holds a connection per open feed and pushes
+these ids as they arrive, instead of having the page poll the feed.
+
+Messages of a channel are numbered, so a client reconnecting with the number
+of the last message it got (the ``Last-Event-ID`` of server-sent events)
+receives what it missed, as long as it is still kept by the backend. A number
+above the latest one of the channel comes from numbering that has since been
+lost, and the messages still kept are delivered again.
+"""
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.core.cache import cache
+
+from actstream import cache_keys, settings
+
+
+class MemoryBackend(object):
+    """
+    Channels kept in the memory of the current process, waking up waiting
+    subscribers as soon as a message is published. Only reaches the
+    subscribers of the same process, eg. in tests or with a development
+    server.
+    """
+
+    def __init__(self, size=100):
+        self._messages = defaultdict(lambda: deque(maxlen=size))
+        self._last_ids = defaultdict(int)
+        self._condition = threading.Condition()
+
+    def publish(self, channel, message):
+        with self._condition:
+            self._last_ids[channel] += 1
+            self._messages[channel].append((self._last_ids[channel], message))
+            self._condition.notify_all()
+
+    def last_id(self, channel):
+        """
+        Returns the number of the latest message of the channel
+        """
+        with self._condition:
+            return self._last_ids.get(channel, 0)
+
+    def fetch(self, channel, after, timeout=0):
+        """
+        Returns the ``(number, message)`` tuples of the channel numbered
+        after ``after``, waiting up to ``timeout`` seconds for one.
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            if after > self._last_ids.get(channel, 0):
+                after = 0
+            while True:
+                messages = [(number, message) for number, message in
+                            self._messages.get(channel, ()) if number > after]
+                remaining = deadline - time.time()
+                if messages or remaining <= 0:
+                    return messages
+                self._condition.wait(remaining)
+
+
+class CacheBackend(object):
+    """
+    Channels kept in Django's cache, shared by every process using the same
+    cache. Message numbers come from ``cache.incr``, so concurrent publishers
+    do not overwrite each other, on a counter seeded with the time.
+    Subscribers check for new messages every ``poll_interval`` seconds, a
+    cache read each.
+    """
+
+    def __init__(self, size=100, timeout=300, poll_interval=1):
+        self.size = size
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def _key(self, channel, *parts):
+        return cache_keys.make_key('pubsub', channel, *parts)
+
+    def _seed(self):
+        # seeded with the time so a counter expired or evicted from the cache
+        # does not come back to numbers subscribers have already seen
+        return int(time.time() * 1000)
+
+    def publish(self, channel, message):
+        key = self._key(channel)
+        cache.add(key, self._seed(), self.timeout)
+        try:
+            number = cache.incr(key)
+        except ValueError:
+            # the counter expired in between
+            number = self._seed()
+            cache.add(key, number, self.timeout)
+            number = cache.get(key, number)
+        cache.set(self._key(channel, number), message, self.timeout)
+
+    def last_id(self, channel):
+        return cache.get(self._key(channel)) or 0
+
+    def fetch(self, channel, after, timeout=0):
+        deadline = time.time() + timeout
+        while True:
+            last_id = self.last_id(channel)
+            if last_id < after:
+                # numbered by a counter that has since been lost
+                after = 0
+            if last_id > after:
+                numbers = range(max(after + 1, last_id - self.size + 1),
+                                last_id + 1)
+                found = cache.get_many([self._key(channel, number)
+                                        for number in numbers])
+                messages = [(number, found[self._key(channel, number)])
+                            for number in numbers
+                            if self._key(channel, number) in found]
+                if messages:
+                    return messages
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return []
+            time.sleep(min(self.poll_interval, remaining))
+
+
+BACKENDS = {
+    'memory': lambda: MemoryBackend(),
+    'cache': lambda: CacheBackend(),
+}
+
+_backend = None
+
+
+def is_enabled():
+    """
+    Returns True if new actions are published
+    """
+    return settings.PUBSUB_BACKEND is not None
+
+
+def get_backend():
+    """
+    Returns the configured publication backend
+    """
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[settings.PUBSUB_BACKEND]()
+    return _backend
+
+
+def reset_backend():
+    """
+    Drops the configured backend so that it is rebuilt from the settings on
+    the next access.
+    """
+    global _backend
+    _backend = None
+
+
+def user_channel(user_id):
+    return 'user:%s' % user_id
+
+
+def publish_action(action):
+    """
+    Publishes the id of a newly saved action to the users whose following
+    feed it enters
+    """
+    from actstream.views import feed_follower_ids
+
+    if not is_enabled():
+        return
+    backend = get_backend()
+    for user_id in feed_follower_ids(action):
+        backend.publish(user_channel(user_id), action.pk)
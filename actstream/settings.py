@@ -15,6 +15,36 @@ def get_models():
         models[model.lower()] = get_model(*model.split('.'))
     return models
 
+_actionable = {}
+
+def get_actionable_models():
+    """
+    Returns a frozenset of the model classes configured in
+    ACTSTREAM_SETTINGS['MODELS']. Built on first use and memoized, call
+    ``reset_actionable_models`` after changing the setting.
+    """
+    if 'models' not in _actionable:
+        _actionable['models'] = frozenset(
+            model for model in get_models().values() if model)
+    return _actionable['models']
+
+def get_actionable_content_types():
+    """
+    Returns a lookup of content type id: <model class> of the actionable models
+    """
+    if 'content_types' not in _actionable:
+        from django.contrib.contenttypes.models import ContentType
+        _actionable['content_types'] = dict(
+            (ContentType.objects.get_for_model(model).pk, model)
+            for model in get_actionable_models())
+    return _actionable['content_types']
+
+def reset_actionable_models():
+    """
+    Forgets the memoized actionable models (eg. when tests change MODELS)
+    """
+    _actionable.clear()
+
 def get_action_manager():
     """
     Returns the class of the action manager to use from ACTSTREAM_SETTINGS['MANAGER']
@@ -31,3 +61,41 @@ FETCH_RELATIONS = SETTINGS.get('FETCH_RELATIONS', True)
 GFK_FETCH_DEPTH = SETTINGS.get('GFK_FETCH_DEPTH', 0)
 
 USE_JSONFIELD = SETTINGS.get('USE_JSONFIELD', False)
+
+FANOUT_ON_WRITE = SETTINGS.get('FANOUT_ON_WRITE', ())
+
+GFK_CACHE = SETTINGS.get('GFK_CACHE', None)
+
+GFK_CACHE_ALIAS = SETTINGS.get('GFK_CACHE_ALIAS', 'default')
+
+GFK_CACHE_SIZE = SETTINGS.get('GFK_CACHE_SIZE', 1000)
+
+GFK_CACHE_TIMEOUT = SETTINGS.get('GFK_CACHE_TIMEOUT', 300)
+
+INGESTION = SETTINGS.get('INGESTION', 'sync')
+
+QUEUE_BACKEND = SETTINGS.get('QUEUE_BACKEND', 'sqlite')
+
+QUEUE_PATH = SETTINGS.get('QUEUE_PATH', None)
+
+QUEUE_BATCH_SIZE = SETTINGS.get('QUEUE_BATCH_SIZE', 500)
+
+QUEUE_MAX_AGE = SETTINGS.get('QUEUE_MAX_AGE', 5)
+
+FOLLOW_CACHE_TIMEOUT = SETTINGS.get('FOLLOW_CACHE_TIMEOUT', 60 * 60)
+
+BATCH_GROUPS = SETTINGS.get('BATCH_GROUPS', False)
+
+ACTOR_STREAM_CACHE_SIZE = SETTINGS.get('ACTOR_STREAM_CACHE_SIZE', 1000)
+
+ACTOR_STREAM_CACHE_TIMEOUT = SETTINGS.get('ACTOR_STREAM_CACHE_TIMEOUT', 60 * 60)
+
+MAX_PAGE_SIZE = SETTINGS.get('MAX_PAGE_SIZE', 100)
+
+FEED_PLAN_CACHE_TIMEOUT = SETTINGS.get('FEED_PLAN_CACHE_TIMEOUT', 30)
+
+NEW_ACTIVITY_COUNT_LIMIT = SETTINGS.get('NEW_ACTIVITY_COUNT_LIMIT', 99)
+
+PUBSUB_BACKEND = SETTINGS.get('PUBSUB_BACKEND', None)
+
+EVENTS_TIMEOUT = SETTINGS.get('EVENTS_TIMEOUT', 30)
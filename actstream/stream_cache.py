@@ -0,0 +1,123 @@
+"""
+Cache of actor streams.
+
+The ``(id, timestamp)`` pairs of the latest public actions of an actor are
+kept in Django's cache, newest first, up to ``ACTOR_STREAM_CACHE_SIZE``
+entries. Pages are sliced out of that list and only their actions are loaded.
+New actions of an actor are inserted into its cached list as they are saved,
+under a lock taken with ``cache.add`` so that concurrent inserts do not
+overwrite each other; any other change to its actions drops the list.
+"""
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
+
+from actstream import cache_keys, settings
+
+# seconds a push may hold the lock of a cached stream
+LOCK_TIMEOUT = 5
+
+
+def cache_key(content_type_id, object_id):
+    return cache_keys.make_key('actor_stream', content_type_id, object_id)
+
+
+def _actor_key(actor):
+    return cache_key(ContentType.objects.get_for_model(actor).pk,
+                     smart_unicode(actor.pk))
+
+
+def _action_key(action):
+    return cache_key(action.actor_content_type_id,
+                     smart_unicode(action.actor_object_id))
+
+
+def get_entries(actor):
+    """
+    Returns the cached ``(id, timestamp)`` pairs of the actor's stream,
+    loading them when they are not cached.
+    """
+    from actstream.models import Action
+
+    key = _actor_key(actor)
+    entries = cache.get(key)
+    if entries is None:
+        entries = list(Action.objects.public(
+            actor_content_type=ContentType.objects.get_for_model(actor),
+            actor_object_id=actor.pk,
+        ).order_by('-timestamp', '-id').values_list(
+            'id', 'timestamp')[:settings.ACTOR_STREAM_CACHE_SIZE])
+        cache.set(key, entries, settings.ACTOR_STREAM_CACHE_TIMEOUT)
+    return entries
+
+
+def actor_page(actor, start, stop):
+    """
+    Returns the actions ``start`` to ``stop`` of the actor's stream. Pages
+    beyond the cached entries are read from the database.
+    """
+    from actstream.models import Action, actor_stream
+
+    entries = get_entries(actor)
+    if stop > len(entries) >= settings.ACTOR_STREAM_CACHE_SIZE:
+        return list(actor_stream(actor, _offset=start, _limit=stop))
+    ids = [pk for pk, timestamp in entries[start:stop]]
+    if not ids:
+        return []
+    actions = dict((action.pk, action) for action in Action.objects.filter(
+        pk__in=ids).fetch_generic_relations())
+    return [actions[pk] for pk in ids if pk in actions]
+
+
+def push(action):
+    """
+    Inserts a newly saved action into the cached stream of its actor
+    """
+    if not action.public or action.state != 1:
+        return
+    key = _action_key(action)
+    lock = cache_keys.make_key('actor_stream_lock', key)
+    if not cache.add(lock, 1, LOCK_TIMEOUT):
+        # another action of the actor is being inserted, an insert made
+        # meanwhile would be overwritten
+        cache.delete(key)
+        return
+    try:
+        entries = cache.get(key)
+        if entries is None:
+            return
+        entry = (action.pk, action.timestamp)
+        position = 0
+        while position < len(entries) and (entries[position][1],
+                entries[position][0]) > (entry[1], entry[0]):
+            position += 1
+        entries.insert(position, entry)
+        cache.set(key, entries[:settings.ACTOR_STREAM_CACHE_SIZE],
+                  settings.ACTOR_STREAM_CACHE_TIMEOUT)
+    finally:
+        cache.delete(lock)
+
+
+def invalidate(action):
+    """
+    Drops the cached stream of the action's actor
+    """
+    cache.delete(_action_key(action))
+
+
+def invalidate_actor(actor):
+    """
+    Drops the cached stream of an actor
+    """
+    cache.delete(_actor_key(actor))
+
+
+def action_saved(sender, instance, created=False, raw=False, **kwargs):
+    """
+    Signal handler keeping the cached stream of the actor of a saved or
+    deleted action up to date.
+    """
+    if created and not raw:
+        push(instance)
+    else:
+        invalidate(instance)
@@ -1,3 +1,4 @@
+from actstream import batching, cache_keys, identity_map
 from actstream.models import Follow, Action
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
@@ -158,6 +159,10 @@ class ShareActivityCount(Node):
 
     def render(self, context):
         action_instance = self.action.resolve(context)
+        if hasattr(action_instance, 'share_count'):
+            # preloaded by Action.objects.preload_shares
+            context[self.context_var] = action_instance.share_count
+            return ''
         target_content_type = ContentType.objects.get_for_model(action_instance)
         context[self.context_var] = Action.objects.filter(verb=settings.SHARE_VERB, target_content_type=target_content_type, target_object_id = action_instance.pk).count()
         return  ''
@@ -173,6 +178,10 @@ class CanShareActivity(Node):
              context[self.context_var] = 0
              return ''
         action_instance = self.action.resolve(context)
+        if hasattr(action_instance, 'can_share'):
+            # preloaded by Action.objects.preload_shares
+            context[self.context_var] = int(action_instance.can_share)
+            return ''
         actor_content_type = ContentType.objects.get_for_model(user)
         target_content_type = ContentType.objects.get_for_model(action_instance)
         alreadyShared = Action.objects.filter(actor_content_type=actor_content_type,actor_object_id=user._get_pk_val(), verb=settings.SHARE_VERB, target_content_type=target_content_type, target_object_id = action_instance.pk).count()
@@ -520,7 +529,7 @@ class GetListOfBatchedActionIDs(Node):
     def render(self, context):
         try:
             user = context['request'].user
-            action_id_maps = cache.get(user.username+"batched_actions")
+            action_id_maps = cache.get(cache_keys.user_key(user, 'batched_actions'))
             action_id_list = []
             if action_id_maps:
                 action_id_list = action_id_maps.values()
@@ -553,10 +562,11 @@ class GetActionTarget(Node):
     def render(self, context):
         try:
             action_id = resolve_variable(self.action_id, context)
-            action_object = Action.objects.get(id=action_id)
+            action_object = identity_map.get_action(action_id)
         except VariableDoesNotExist:
             return ''
-        context[self.context_var] = action_object.target
+        context[self.context_var] = identity_map.get_related(action_object,
+                                                             'target')
         return ''
 
 def do_get_batched_targets(parser, token):
@@ -576,6 +586,8 @@ def do_get_batched_targets(parser, token):
     return GetBatchedTargets(bits[1],bits[2],bits[4])
 
 class GetBatchedTargets(Node):
+    field = 'target'
+
     def __init__(self, action_ids, parent_action_id, context_var):
         self.action_ids = action_ids
         self.context_var = context_var
@@ -585,22 +597,37 @@ class GetBatchedTargets(Node):
         try:
             action_ids = resolve_variable(self.action_ids, context)
             parent_action_id = resolve_variable(self.parent_action_id, context)
-            targets = []
-            if action_ids:
-                for action_id in action_ids:
-                    action_object = Action.objects.get(id=action_id)
-                    targets.append(action_object.target)
-
-            unique_targets = list(set(targets))
-            parent_action_object = Action.objects.get(id=parent_action_id)
-            parent_action_target = parent_action_object.target
-            if parent_action_target in unique_targets:
-                unique_targets.remove(parent_action_target)    
         except VariableDoesNotExist:
             return ''
-        context[self.context_var] = unique_targets
+        objects = []
+        if action_ids:
+            actions = _batched_actions(context, action_ids, parent_action_id)
+            objects = batching.batched_objects(actions, action_ids,
+                                               parent_action_id, self.field)
+        context[self.context_var] = objects
         return ''
 
+
+def _batched_actions(context, action_ids, parent_action_id):
+    """
+    Returns the batched actions of the page by id. The first batch tag of a
+    render loads the batches of every parent of ``action_list`` found in
+    ``batched_actions`` at once.
+    """
+    actions = context.render_context.get('actstream_batched_actions')
+    if actions is None:
+        batched_actions = context.get('batched_actions') or {}
+        page = set(getattr(action, 'pk', None) for action in
+                   context.get('action_list') or ()) if batched_actions else ()
+        actions = batching.resolve_batches(batched_actions, [
+            pk for pk in batched_actions if pk in page])
+        context.render_context['actstream_batched_actions'] = actions
+    if parent_action_id not in actions or any(
+            pk not in actions for pk in action_ids):
+        actions.update(batching.resolve_batches(
+            {parent_action_id: action_ids}))
+    return actions
+
 def do_get_action_actor(parser, token):
     """
     Retrieves the list of broadcasters for an action and stores them in a context variable which has
@@ -625,10 +652,11 @@ class GetActionActor(Node):
     def render(self, context):
         try:
             action_id = resolve_variable(self.action_id, context)
-            action_object = Action.objects.get(id=action_id)
+            action_object = identity_map.get_action(action_id)
         except VariableDoesNotExist:
             return ''
-        context[self.context_var] = action_object.actor
+        context[self.context_var] = identity_map.get_related(action_object,
+                                                             'actor')
         return ''
 
 def do_get_batched_actors(parser, token):
@@ -647,31 +675,8 @@ def do_get_batched_actors(parser, token):
         raise TemplateSyntaxError("second argument to '%s' tag must be 'as'" % bits[0])
     return GetBatchedActors(bits[1],bits[2],bits[4])
 
-class GetBatchedActors(Node):
-    def __init__(self, action_ids, parent_action_id, context_var):
-        self.action_ids = action_ids
-        self.parent_action_id = parent_action_id
-        self.context_var = context_var
-
-    def render(self, context):
-        try:
-            action_ids = resolve_variable(self.action_ids, context)
-            parent_action_id = resolve_variable(self.parent_action_id, context)
-            actors = []
-            if action_ids:
-                for action_id in action_ids:
-                    action_object = Action.objects.get(id=action_id)
-                    actors.append(action_object.actor)
-
-            unique_actors = list(set(actors))
-            parent_action_object = Action.objects.get(id=parent_action_id)
-            parent_actor = parent_action_object.actor
-            if parent_actor in unique_actors:
-                unique_actors.remove(parent_actor)    
-        except VariableDoesNotExist:
-            return ''
-        context[self.context_var] = unique_actors
-        return ''
+class GetBatchedActors(GetBatchedTargets):
+    field = 'actor'
 
 register.filter(is_following)
 register.filter(get_class_name)
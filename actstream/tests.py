@@ -1,20 +1,48 @@
-from random import choice
+import json
+from datetime import timedelta
+from random import choice, Random
 
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.http import Http404
 from django.db import connection
 from django.db.models import get_model
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
 from django.conf import settings
 from django.contrib.auth.models import User, AnonymousUser, Group
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.template.loader import Template, Context
+from django.utils import timezone
+from django.utils.unittest import skipUnless
 
-from actstream.models import Action, Follow, model_stream, user_stream,\
-    setup_generic_relations, following, followers
-from actstream.actions import follow, unfollow
-from actstream.exceptions import ModelNotActionable
+from follow import utils as follow_utils
+
+from actstream.models import Action, Follow, FollowCount, InboxEntry,\
+    model_stream, user_stream, actor_stream, target_stream,\
+    action_object_stream, setup_generic_relations, following, followers
+from actstream.actions import follow, unfollow, follow_many, unfollow_many,\
+    save_actions, bulk_action, _insert_follow
+from actstream.batching import group_actions, collapse_batches,\
+    batched_children
+from actstream.cursors import encode_cursor
+from actstream.exceptions import ModelNotActionable, BadCursor,\
+    check_actionable_model
 from actstream.signals import action
-from actstream.settings import get_models, SETTINGS
+from actstream.views import _page_size, get_actions_following,\
+    actstream_latest_activity_count, feed_follower_ids,\
+    _followed_content_types, _following_feed
+from actstream.settings import get_models, get_actionable_models,\
+    get_actionable_content_types, reset_actionable_models, SETTINGS
+from actstream import cache_keys, feed_plan, identity_map, ingestion,\
+    object_cache, pubsub, stream_cache, watermark,\
+    settings as actstream_settings
+
+# the following feeds also match the groups followed with django-follow
+follow_utils.register(Group)
+
 
 class LTE(int):
     def __new__(cls, n):
@@ -28,18 +56,27 @@ class LTE(int):
     def __repr__(self):
         return "<= %s" % self.n
 
-class ActivityBaseTestCase(TestCase):
+class ActivityBaseMixin(object):
     actstream_models = ()
 
     def setUp(self):
+        # cached follows and streams are keyed by primary keys, which the
+        # tests reuse
+        cache.clear()
         self.old_models = get_models()
         SETTINGS['MODELS'] = {}
         for model in self.actstream_models:
             SETTINGS['MODELS'][model.lower()] = get_model(*model.split('.'))
+        reset_actionable_models()
         setup_generic_relations()
 
     def tearDown(self):
         SETTINGS['MODELS'] = self.old_models
+        reset_actionable_models()
+
+
+class ActivityBaseTestCase(ActivityBaseMixin, TestCase):
+    pass
 
 
 class ActivityTestCase(ActivityBaseTestCase):
@@ -169,6 +206,288 @@ class ActivityTestCase(ActivityBaseTestCase):
         self.assertEquals(f1, f2, "Should have received the same Follow "
             "object that I first submitted")
 
+    def test_follow_many(self):
+        others = [User.objects.create(username='other%d' % i) for i in range(3)]
+        followed = [self.user2, self.group] + others
+        # existing follows lookup, bulk insert and primary keys lookup; the
+        # follow count upkeep: a lookup and an update for each of the 2
+        # content types and for the following count, and up to 4 queries per
+        # count not created yet; plus up to 5 queries per inbox backfill
+        queries = 3 + 2 * 3 + 4 * (len(followed) + 1) + \
+            4 * 5 * len(actstream_settings.FANOUT_ON_WRITE)
+        with self.assertNumQueries(LTE(queries)):
+            follows = follow_many(self.user1, followed, send_action=False)
+        self.assertEqual(len(follows), 4)
+        self.assertEqual(set(follow.pk for follow in follows),
+            set(Follow.objects.filter(user=self.user1).exclude(
+                object_id=self.user2.pk).values_list('pk', flat=True)))
+        self.assertEqual(set(following(self.user1)), set(followed))
+        self.assertEqual(follow_many(self.user1, others, send_action=False), [])
+
+        unfollow_many(self.user1, others + [self.user2])
+        self.assertEqual(list(following(self.user1)), [self.group])
+
+    def test_insert_follow(self):
+        # a follow created concurrently is skipped instead of raising
+        duplicate = Follow(user=self.user1, object_id=self.user2.pk,
+            content_type=ContentType.objects.get_for_model(User),
+            site_id=settings.SITE_ID)
+        self.assertFalse(_insert_follow(duplicate))
+        self.assertEqual(duplicate.pk, None)
+        self.assertEqual(Follow.objects.filter(user=self.user1).count(), 1)
+
+    def test_follow_counts(self):
+        self.assertEqual(Follow.objects.followers_count(self.user2), 1)
+        self.assertEqual(Follow.objects.following_count(self.user1), 1)
+        follow(self.user1, self.group, send_action=False)
+        self.assertEqual(Follow.objects.followers_count(self.group), 2)
+        self.assertEqual(Follow.objects.following_count(self.user1), 2)
+        unfollow(self.user1, self.user2)
+        self.assertEqual(Follow.objects.followers_count(self.user2), 0)
+        self.assertEqual(Follow.objects.following_count(self.user1), 1)
+
+        Follow.objects.filter(user=self.user1).delete()
+        call_command('actstream_reconcile_follow_counts', verbosity=0,
+                     skip_validation=True)
+        self.assertEqual(Follow.objects.followers_count(self.group), 1)
+        self.assertEqual(Follow.objects.following_count(self.user1), 0)
+
+    def test_follow_count_created_concurrently(self):
+        group_type = ContentType.objects.get_for_model(Group).pk
+        FollowCount.objects.filter(content_type=group_type).delete()
+        compute = FollowCount.objects.compute
+
+        def racing_compute(content_type_id, object_id):
+            # another request creates the counts first, without this follow
+            FollowCount.objects.create(
+                content_type_id=content_type_id, site_id=settings.SITE_ID,
+                object_id=object_id, followers_count=1)
+            return compute(content_type_id, object_id)
+        FollowCount.objects.compute = racing_compute
+        try:
+            follow(self.user1, self.group, send_action=False)
+        finally:
+            del FollowCount.objects.compute
+        self.assertEqual(Follow.objects.followers_count(self.group), 2)
+
+    def test_followed_since(self):
+        self.assertEqual(set(Action.objects.followed_since(self.user1)),
+                         set(Action.objects.actor(self.user2)))
+        follow(self.user1, self.group, send_action=False)
+        sql = Action.objects.followed_since(self.user1).query.sql_with_params()
+        self.assertEqual(sql[0], Action.objects.followed_since(
+            self.user2).query.sql_with_params()[0])
+        self.assertEqual(set(Action.objects.followed_since(self.user1)),
+                         set(Action.objects.actor(self.user2)))
+
+        Follow.objects.filter(user=self.user1).update(
+            started=timezone.now() + timedelta(minutes=1))
+        self.assertEqual(list(Action.objects.followed_since(self.user1)), [])
+
+    def test_user_since(self):
+        self.assertEqual(map(unicode, Action.objects.user_since(self.user1)), [
+            u'Two started following CoolGroup 0 minutes ago',
+            u'Two joined CoolGroup 0 minutes ago',
+        ])
+        follow(self.user1, self.group, actor_only=False, send_action=False)
+        action.send(self.comment, verb='mentioned', target=self.group)
+        action.send(self.user2, verb='viewed', target=self.group)
+        self.assertEqual(map(unicode, Action.objects.user_since(self.user1)), [
+            u'admin: Sweet Group!... mentioned CoolGroup 0 minutes ago',
+            u'Two started following CoolGroup 0 minutes ago',
+            u'Two joined CoolGroup 0 minutes ago',
+        ])
+
+    def test_following_feed(self):
+        group_type = ContentType.objects.get_for_model(Group)
+        follow(self.user1, self.group, actor_only=False, send_action=False)
+        self.assertEqual(_followed_content_types(self.user1), [group_type.pk])
+        feed = lambda: set(_following_feed(self.user1, [group_type.pk])
+                           .values_list('verb', flat=True))
+        action.send(self.comment, verb='mentioned', target=self.group)
+        # only the objects also followed with django-follow are matched
+        self.assertFalse('mentioned' in feed())
+        follow_utils.follow(self.user1, self.group)
+        Action.objects.filter(verb='mentioned').update(
+            timestamp=timezone.now() - timedelta(hours=1))
+        action.send(self.comment, verb='praised', target=self.group)
+        self.assertTrue('praised' in feed())
+        self.assertFalse('mentioned' in feed())
+
+        # the query does not grow with the followed objects
+        sql = _following_feed(self.user1, [group_type.pk]).query
+        other = Group.objects.create(name='OtherGroup')
+        follow(self.user1, other, actor_only=False, send_action=False)
+        follow_utils.follow(self.user1, other)
+        self.assertEqual(
+            _following_feed(self.user1, [group_type.pk]).query.sql_with_params(),
+            sql.sql_with_params())
+
+    def test_feed_plan(self):
+        builds = []
+        build = lambda: builds.append(1) or {'content_types': []}
+        feed_plan.get_plan(self.user1, self.user1, build)
+        self.assertEqual(feed_plan.get_plan(self.user1, self.user1, build),
+                         {'content_types': []})
+        self.assertEqual(len(builds), 1)
+        follow(self.user1, self.group, send_action=False)
+        feed_plan.get_plan(self.user1, self.user1, build)
+        self.assertEqual(len(builds), 2)
+        unfollow(self.user1, self.group)
+        feed_plan.get_plan(self.user1, self.user1, build)
+        self.assertEqual(len(builds), 3)
+
+        feed_plan.invalidate(self.user1)
+        request = RequestFactory().get('/')
+        request.user = self.user1
+        args = (request, ContentType.objects.get_for_model(User).pk,
+                self.user1.pk)
+        # the content type, the actor, the follows and the feed
+        with self.assertNumQueries(4):
+            first = list(get_actions_following(*args))
+        # the next poll reuses the plan: the content type, the actor and the
+        # feed, none of the follow lookups
+        with self.assertNumQueries(3):
+            self.assertEqual(list(get_actions_following(*args)), first)
+        # following with django-follow drops the plan too
+        follow_utils.follow(self.user1, self.group)
+        with self.assertNumQueries(4):
+            list(get_actions_following(*args))
+        follow_utils.unfollow(self.user1, self.group)
+        with self.assertNumQueries(4):
+            list(get_actions_following(*args))
+
+    def test_watermark(self):
+        self.assertEqual(watermark.latest_action_id(),
+                         Action.objects.order_by('-id')[0].pk)
+        action.send(self.user1, verb='waved', target=self.group)
+        latest = Action.objects.get(verb='waved').pk
+        with self.assertNumQueries(0):
+            self.assertEqual(watermark.latest_action_id(), latest)
+        # a save reporting an older action late does not lower it
+        waved = Action.objects.get(pk=latest)
+        cache.set(watermark.cache_key(), latest + 5)
+        watermark.raise_to(waved)
+        self.assertEqual(watermark.latest_action_id(), latest + 5)
+        cache.delete(watermark.cache_key())
+        watermark.raise_to(waved)
+        self.assertEqual(cache.get(watermark.cache_key()), latest)
+
+    def test_latest_activity_count(self):
+        old_settings = (actstream_settings.BATCH_GROUPS,
+                        actstream_settings.NEW_ACTIVITY_COUNT_LIMIT)
+        actstream_settings.NEW_ACTIVITY_COUNT_LIMIT = 2
+        request = RequestFactory().get('/')
+        request.user = self.user1
+        request.session = {'last_processed_action':
+                           Action.objects.order_by('-id')[0].pk}
+        args = (request, ContentType.objects.get_for_model(User).pk,
+                self.user1.pk)
+        try:
+            for batch_groups in (False, True):
+                actstream_settings.BATCH_GROUPS = batch_groups
+                for i in range(4):
+                    action.send(self.user2, verb='posted %d %s' % (
+                        i, batch_groups), target=self.group)
+                feed_plan.invalidate(self.user1)
+                with self.assertNumQueries(LTE(4)):
+                    response = actstream_latest_activity_count(*args)
+                # the count reads at most limit + 1 rows
+                self.assertTrue('LIMIT 3' in connection.queries[-1]['sql'])
+                self.assertEqual(json.loads(response.content),
+                    {'success': True, 'count': 2, 'display': '2+'})
+        finally:
+            (actstream_settings.BATCH_GROUPS,
+             actstream_settings.NEW_ACTIVITY_COUNT_LIMIT) = old_settings
+
+    def test_feed_follower_ids(self):
+        follow(self.user1, self.group, actor_only=False, send_action=False)
+        follow_utils.follow(self.user1, self.group)
+        follow(self.user2, self.comment, actor_only=False, send_action=False)
+        # followed with actstream only
+        other = Group.objects.create(name='OtherGroup')
+        follow(self.user1, other, actor_only=False, send_action=False)
+        action.send(self.comment, verb='mentioned', target=self.group)
+        action.send(self.comment, verb='mentioned', target=other)
+        action.send(self.user2, verb='waved', target=self.comment)
+        action.send(self.user1, verb=settings.SAID_VERB, target=self.group)
+        action.send(self.user1, verb='waved', target=self.group)
+
+        request = RequestFactory().get('/')
+        for user in (self.user1, self.user2):
+            request.user = user
+            feed = get_actions_following(
+                request, ContentType.objects.get_for_model(User).pk, user.pk)
+            self.assertEqual(
+                set(feed.values_list('pk', flat=True)),
+                set(a.pk for a in Action.objects.all()
+                    if user.pk in feed_follower_ids(a)))
+
+    def test_pubsub(self):
+        channel = pubsub.user_channel(self.user1.pk)
+        old_backend = actstream_settings.PUBSUB_BACKEND
+        try:
+            for name in ('memory', 'cache'):
+                actstream_settings.PUBSUB_BACKEND = name
+                pubsub.reset_backend()
+                backend = pubsub.get_backend()
+                last_id = backend.last_id(channel)
+                # a distinct verb per backend, same-day duplicates are merged
+                action.send(self.user2, verb='waved at %s' % name,
+                            target=self.group)
+                waved = Action.objects.get(verb='waved at %s' % name)
+                number = backend.last_id(channel)
+                self.assertTrue(number > last_id)
+                self.assertEqual(backend.fetch(channel, last_id),
+                                 [(number, waved.pk)])
+                self.assertEqual(backend.fetch(channel, number), [])
+                self.assertEqual(backend.fetch(
+                    pubsub.user_channel(self.user2.pk), 0), [])
+                # a client numbered by a lost counter gets the kept messages
+                self.assertEqual(backend.fetch(channel, number + 1000),
+                                 [(number, waved.pk)])
+
+            # the cache counter restarts above the numbers already seen
+            cache.delete(backend._key(channel))
+            backend.publish(channel, waved.pk)
+            self.assertTrue(backend.last_id(channel) > number)
+        finally:
+            actstream_settings.PUBSUB_BACKEND = old_backend
+            pubsub.reset_backend()
+
+    def test_lazy_follows(self):
+        fans = [User.objects.create(username='fan%d' % i) for i in range(4)]
+        for fan in fans:
+            follow(fan, self.group, send_action=False)
+        followers = Follow.objects.lazy_followers(self.group, page_size=2)
+        self.assertEqual(len(followers), 5)
+        self.assertEqual(list(followers), [self.user2] + fans)
+        with self.assertNumQueries(1):
+            self.assertEqual(followers[1:3], fans[:2])
+        page, after = followers.page(limit=3)
+        self.assertEqual(page, [self.user2] + fans[:2])
+        self.assertEqual(followers.page(after, 3), (fans[2:], None))
+        # indexed like a list
+        self.assertEqual(followers[-2:], fans[2:])
+        self.assertEqual(followers[1:-2], fans[:2])
+        self.assertEqual(followers[3:1], [])
+        self.assertEqual(followers[-5], self.user2)
+        self.assertRaises(IndexError, lambda: followers[-6])
+        self.assertRaises(IndexError, lambda: followers[5])
+        self.assertRaises(TypeError, lambda: followers['1'])
+
+        follow(self.user1, self.group, send_action=False)
+        following = Follow.objects.lazy_following(self.user1)
+        self.assertEqual(len(following), 2)
+        self.assertEqual(list(following), [self.user2, self.group])
+        self.assertEqual(following[-1], self.group)
+        # the follows of the page and one query per followed model
+        with self.assertNumQueries(3):
+            self.assertEqual(following[0:2], [self.user2, self.group])
+        self.assertEqual(
+            list(Follow.objects.lazy_following(self.user1, Group)),
+            [self.group])
+
     def test_y_no_orphaned_follows(self):
         follows = Follow.objects.count()
         self.user2.delete()
@@ -188,6 +507,118 @@ class ActivityTestCase(ActivityBaseTestCase):
         self.assertRaises(ModelNotActionable, follow, self.user1,
                           ContentType.objects.get_for_model(self.user1))
 
+    def test_actionable_models_memoized(self):
+        self.assertNumQueries(0, lambda: [check_actionable_model(self.user1)
+                                          for i in range(10)])
+        self.assertEqual(get_actionable_content_types()[
+            ContentType.objects.get_for_model(Group).pk], Group)
+
+        models = get_actionable_models()
+        content_types = get_actionable_content_types()
+        # the setting is only read again after a reset
+        SETTINGS['MODELS'] = {'auth.user': User}
+        self.assertTrue(get_actionable_models() is models)
+        self.assertTrue(get_actionable_content_types() is content_types)
+        self.assertTrue(Group in get_actionable_models())
+        reset_actionable_models()
+        self.assertEqual(get_actionable_models(), frozenset([User]))
+
+    def test_same_day_action_is_refreshed(self):
+        count = Action.objects.count()
+        self.assertNumQueries(LTE(2), lambda: action.send(self.user1,
+            verb='commented on', target=self.group))
+        self.assertEqual(count, Action.objects.count())
+
+    def test_deleted_action_is_not_refreshed(self):
+        deleted = Action.objects.get(verb='commented on')
+        deleted.state = -1
+        deleted.save()
+        action.send(self.user1, verb='commented on', target=self.group)
+        self.assertEqual(Action.objects.filter(verb='commented on').count(), 2)
+
+    def test_collapse_duplicates_command(self):
+        duplicate = Action.objects.get(verb='commented on')
+        duplicate.pk = duplicate.dedup_key = None
+        duplicate.save()
+        call_command('actstream_collapse_duplicates', verbosity=0,
+                     skip_validation=True)
+        collapsed = Action.objects.get(verb='commented on')
+        self.assertEqual(collapsed.pk, duplicate.pk)
+        self.assertEqual(collapsed.dedup_key, collapsed.get_dedup_key())
+
+    def test_bulk_action(self):
+        users = [User.objects.create(username='bulk%d' % i) for i in range(5)]
+        count = Action.objects.count()
+        inserted = bulk_action(({'actor': user, 'verb': 'joined',
+                                 'target': self.group}
+                                for user in users + users[:2]), batch_size=3)
+        self.assertEqual(inserted, 5)
+        self.assertEqual(Action.objects.count(), count + 5)
+        # already recorded today
+        self.assertEqual(bulk_action([{'actor': self.user1,
+            'verb': 'commented on', 'target': self.group}]), 0)
+        self.assertRaises(ModelNotActionable, bulk_action, [{
+            'actor': self.user1, 'verb': 'bad',
+            'target': ContentType.objects.get_for_model(self.user1)}])
+
+    def test_preload_shares(self):
+        joined = Action.objects.get(verb='joined', actor_object_id=self.user1.pk)
+        other = Action.objects.get(verb='joined', actor_object_id=self.user2.pk)
+        for actor in (self.user2, self.group):
+            Action.objects.create(actor=actor, verb='shared', target=joined)
+        with self.assertNumQueries(2):
+            page = Action.objects.preload_shares([joined, other], self.user1,
+                                                 verb='shared')
+        self.assertEqual([a.share_count for a in page], [2, 0])
+        # own actions can not be shared
+        self.assertEqual([a.can_share for a in page], [False, True])
+
+        request = RequestFactory().get('/')
+        request.user = self.user1
+        src = ('{% load activity_tags %}{% get_share_count action as count %}'
+               '{% can_share_action action as can %}{{ count }}:{{ can }}')
+        with self.assertNumQueries(0):
+            output = Template(src).render(Context({'action': page[1],
+                                                   'request': request}))
+        self.assertEqual(output, '0:1')
+
+    def test_identity_map(self):
+        commented = Action.objects.get(verb='commented on')
+        src = ('{% load activity_tags %}'
+               '{% get_action_actor action_id as actor %}'
+               '{% get_action_target action_id as target %}'
+               '{{ actor }} {{ target }}')
+        with identity_map.scope() as current:
+            list(Action.objects.filter(verb='commented on')
+                 .fetch_generic_relations())
+            with self.assertNumQueries(0):
+                output = Template(src).render(Context({
+                    'action_id': commented.pk}))
+            # both tags find the action in the map
+            self.assertEqual(current.hits, 2)
+        self.assertEqual(output, 'admin CoolGroup')
+        self.assertEqual(identity_map.get_identity_map(), None)
+
+    def test_actor_stream_cache(self):
+        expected = list(actor_stream(self.user1))
+        self.assertEqual(stream_cache.actor_page(self.user1, 0, 10), expected)
+        # the ids are cached, only the actions of the page are loaded
+        with self.assertNumQueries(LTE(3)):
+            self.assertEqual(stream_cache.actor_page(self.user1, 1, 2),
+                             expected[1:2])
+        action.send(self.user1, verb='shared', target=self.group)
+        shared = Action.objects.get(verb='shared')
+        self.assertEqual(stream_cache.actor_page(self.user1, 0, 1), [shared])
+        shared.public = False
+        shared.save()
+        self.assertEqual(stream_cache.actor_page(self.user1, 0, 10), expected)
+
+        # an insert running while another one holds the lock drops the list
+        key = stream_cache._actor_key(self.user1)
+        cache.add(cache_keys.make_key('actor_stream_lock', key), 1)
+        action.send(self.user1, verb='liked', target=self.group)
+        self.assertEqual(cache.get(key), None)
+
     def test_hidden_action(self):
         action = self.user1.actor_actions.all()[0]
         action.public = False
@@ -218,6 +649,38 @@ class ActivityTestCase(ActivityBaseTestCase):
                 u'Two joined CoolGroup 0 minutes ago',
                 ])
 
+    def test_stream_cursor_pagination(self):
+        expected = list(model_stream(User))
+        pages, cursor = [], None
+        while True:
+            page = list(model_stream(User, _before=cursor, _limit=2))
+            if not page:
+                break
+            pages.extend(page)
+            cursor = encode_cursor(page[-1])
+        self.assertEqual(pages, expected)
+        self.assertEqual(list(model_stream(User, _after=encode_cursor(
+            expected[1]))), [expected[0]])
+        self.assertRaises(BadCursor, model_stream, User, _before='bogus')
+
+    def test_page_size(self):
+        page_size = lambda limit: _page_size(
+            RequestFactory().get('/', {'limit': limit}), None, 10)
+        self.assertEqual(page_size('20'), 20)
+        self.assertEqual(page_size('100000'), actstream_settings.MAX_PAGE_SIZE)
+        self.assertRaises(Http404, page_size, 'ten')
+        self.assertRaises(Http404, page_size, '-1')
+
+    def test_is_following_cached(self):
+        self.assertTrue(Follow.objects.is_following(self.user1, self.user2))
+        self.assertNumQueries(0, lambda: [
+            Follow.objects.is_following(self.user1, self.group)
+            for i in range(5)])
+        follow(self.user1, self.group, send_action=False)
+        self.assertTrue(Follow.objects.is_following(self.user1, self.group))
+        unfollow(self.user1, self.user2)
+        self.assertFalse(Follow.objects.is_following(self.user1, self.user2))
+
     def test_is_following_filter(self):
         src = '{% load activity_tags %}{% if user|is_following:group %}yup{% endif %}'
         self.assertEqual(Template(src).render(Context({
@@ -228,6 +691,333 @@ class ActivityTestCase(ActivityBaseTestCase):
         })), u'')
 
 
+class FanoutOnWriteTestCase(ActivityBaseTestCase):
+    """
+    Tests of the user stream read from the inbox.
+    """
+    actstream_models = ('auth.User', 'auth.Group')
+
+    def setUp(self):
+        self.old_fanout = actstream_settings.FANOUT_ON_WRITE
+        actstream_settings.FANOUT_ON_WRITE = ('user',)
+        super(FanoutOnWriteTestCase, self).setUp()
+        self.reader = User.objects.create(username='reader')
+        self.author = User.objects.create(username='author')
+        self.group = Group.objects.create(name='InboxGroup')
+
+    def tearDown(self):
+        actstream_settings.FANOUT_ON_WRITE = self.old_fanout
+        super(FanoutOnWriteTestCase, self).tearDown()
+
+    def inbox(self, user):
+        return sorted(InboxEntry.objects.filter(user=user).values_list(
+            'action', flat=True))
+
+    def test_write(self):
+        follow(self.reader, self.author, send_action=False)
+        action.send(self.author, verb='joined', target=self.group)
+        joined = Action.objects.get(verb='joined')
+        self.assertEqual(self.inbox(self.reader), [joined.pk])
+        self.assertEqual(self.inbox(self.author), [])
+        self.assertEqual(list(Action.objects.user(self.reader)), [joined])
+        self.assertEqual(
+            list(Action.objects.user(self.reader)),
+            list(Action.objects.followed_actions(self.reader).filter(
+                public=True, state=1)))
+
+    def test_backfill(self):
+        action.send(self.author, verb='joined', target=self.group)
+        action.send(self.group, verb='opened')
+        follow(self.reader, self.author, send_action=False)
+        follow_many(self.reader, [self.group], send_action=False)
+        self.assertEqual(self.inbox(self.reader), list(
+            Action.objects.order_by('pk').values_list('pk', flat=True)))
+
+        InboxEntry.objects.all().delete()
+        call_command('actstream_backfill_inbox', verbosity=0,
+                     skip_validation=True)
+        self.assertEqual(map(unicode, Action.objects.user(self.reader)), [
+            u'InboxGroup opened 0 minutes ago',
+            u'author joined InboxGroup 0 minutes ago',
+        ])
+
+    def test_unfollow_prunes_inbox(self):
+        follow(self.reader, self.author, send_action=False)
+        follow(self.reader, self.group, actor_only=False, send_action=False)
+        action.send(self.author, verb='joined', target=self.group)
+        action.send(self.author, verb='left')
+        joined = Action.objects.get(verb='joined')
+        unfollow(self.reader, self.author)
+        # still followed through its target
+        self.assertEqual(self.inbox(self.reader), [joined.pk])
+        unfollow(self.reader, self.group)
+        self.assertEqual(self.inbox(self.reader), [])
+
+
+class BufferedIngestionTestCase(ActivityBaseTestCase):
+    actstream_models = ('auth.User', 'auth.Group')
+
+    def setUp(self):
+        super(BufferedIngestionTestCase, self).setUp()
+        self.old_ingestion = (actstream_settings.INGESTION,
+                              actstream_settings.QUEUE_BACKEND)
+        actstream_settings.INGESTION = 'buffered'
+        actstream_settings.QUEUE_BACKEND = 'memory'
+        ingestion.reset_queue()
+        self.user = User.objects.create(username='queued')
+        self.group = Group.objects.create(name='QueuedGroup')
+
+    def tearDown(self):
+        actstream_settings.INGESTION, actstream_settings.QUEUE_BACKEND = \
+            self.old_ingestion
+        ingestion.reset_queue()
+        super(BufferedIngestionTestCase, self).tearDown()
+
+    def test_actions_written_on_flush(self):
+        action.send(self.user, verb='joined', target=self.group)
+        action.send(self.user, verb='joined', target=self.group)
+        action.send(self.user, verb='left', target=self.group)
+        self.assertEqual(Action.objects.count(), 0)
+        self.assertTrue(ingestion.should_flush(batch_size=3))
+        self.assertEqual(ingestion.drain(), 3)
+        self.assertEqual(map(unicode, Action.objects.all()), [
+            u'queued left QueuedGroup 0 minutes ago',
+            u'queued joined QueuedGroup 0 minutes ago',
+        ])
+
+    def test_redelivery_is_deduplicated(self):
+        action.send(self.user, verb='joined', target=self.group)
+        queue = ingestion.get_queue()
+        messages = queue.reserve(10)
+        # the worker dies after writing the batch but before acknowledging it
+        save_actions([ingestion.payload_to_action(payload)
+                      for message_id, payload in messages])
+        queue.release([message_id for message_id, payload in messages])
+        self.assertEqual(ingestion.drain(), 1)
+        self.assertEqual(Action.objects.count(), 1)
+
+    def test_sqlite_queue(self):
+        queue = ingestion.SQLiteQueue(':memory:')
+        queue.put({'verb': 'first'})
+        queue.put({'verb': 'second'})
+        messages = queue.reserve(1)
+        self.assertEqual([payload for message_id, payload in messages],
+                         [{'verb': 'first'}])
+        self.assertEqual(len(queue), 1)
+        queue.release([messages[0][0]])
+        queue.ack([message_id for message_id, payload in queue.reserve(10)])
+        self.assertEqual(len(queue), 0)
+
+    def test_expired_reservations_are_pending(self):
+        for queue in (ingestion.MemoryQueue(),
+                      ingestion.SQLiteQueue(':memory:')):
+            queue.put({'verb': 'first'})
+            queue.reserve(1)
+            self.assertEqual(len(queue), 0)
+            self.assertEqual(queue.oldest_age(), None)
+            # the worker holding the reservation died
+            queue.visibility_timeout = -1
+            self.assertEqual(len(queue), 1)
+            self.assertTrue(queue.oldest_age() >= 0)
+            self.assertEqual([payload for message_id, payload
+                              in queue.reserve(10)], [{'verb': 'first'}])
+
+    def test_sqlite_queue_path(self):
+        old_path = actstream_settings.QUEUE_PATH
+        actstream_settings.QUEUE_BACKEND = 'sqlite'
+        try:
+            actstream_settings.QUEUE_PATH = 'actstream_queue.sqlite3'
+            self.assertRaises(ImproperlyConfigured, ingestion.get_queue)
+        finally:
+            actstream_settings.QUEUE_PATH = old_path
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Inspects SQLite query plans')
+class QueryPlanTestCase(ActivityBaseMixin, TransactionTestCase):
+    """
+    sqlite commits the current transaction before ``EXPLAIN``, so these tests
+    cannot run in the transaction of a ``TestCase``.
+    """
+    actstream_models = ('auth.User', 'auth.Group')
+
+    def setUp(self):
+        super(QueryPlanTestCase, self).setUp()
+        self.user = User.objects.create(username='planner')
+        self.group = Group.objects.create(name='PlannedGroup')
+        action.send(self.user, verb='joined', target=self.group,
+                    action_object=self.user)
+        action.send(self.user, verb='shared', target=self.group)
+
+    def assertUsesIndex(self, queryset, column):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = [row[-1] for row in cursor.fetchall()]
+        self.assertTrue([detail for detail in plan if 'actstream_action' in
+                         detail and '%s=?' % column in detail], plan)
+
+    def test_actor_stream(self):
+        self.assertUsesIndex(actor_stream(self.user), 'actor_object_id')
+
+    def test_target_stream(self):
+        self.assertUsesIndex(target_stream(self.group), 'target_object_id')
+
+    def test_action_object_stream(self):
+        self.assertUsesIndex(action_object_stream(self.user),
+                             'action_object_object_id')
+
+    def test_share_count(self):
+        self.assertUsesIndex(Action.objects.filter(verb='shared',
+            target_content_type=ContentType.objects.get_for_model(Group),
+            target_object_id=self.group.pk).order_by(), 'verb')
+
+
+def legacy_merge_action_subset_op(activity_queryset, sIndex, lIndex,
+                                  batched_actions, follow_verb):
+    """
+    ``views.merge_action_subset_op`` before ``batching.group_actions``,
+    without its session and cache handling.
+    """
+    activities = activity_queryset[sIndex:lIndex]
+
+    for activity in activities:
+        if activity.is_batchable:
+            is_batched=False
+
+            for value in batched_actions.values():
+                if activity.id in value:
+                    is_batched = True
+
+            if not is_batched:
+                batch_minutes = activity.batch_time_minutes
+                if not batch_minutes:
+                    batch_minutes = 30
+
+                cutoff_time = activity.timestamp - timedelta(minutes=batch_minutes)
+
+                groupable_activities = None
+
+                if activity.verb == follow_verb:
+                    actor_content_type   = ContentType.objects.get_for_model(activity.actor)
+                    groupable_activities = activity_queryset.filter(timestamp__gte=cutoff_time,timestamp__lte=activity.timestamp, actor_content_type=actor_content_type, actor_object_id=activity.actor.pk, verb=activity.verb,target_content_type=activity.target_content_type ).exclude(id=activity.id).order_by('-timestamp')
+
+                else:
+                    actor_content_type   = ContentType.objects.get_for_model(activity.actor)
+                    groupable_activities = activity_queryset.filter(timestamp__gte=cutoff_time, timestamp__lte=activity.timestamp, actor_content_type=actor_content_type, verb=activity.verb,target_content_type=activity.target_content_type, target_object_id=activity.target.id ).exclude(id=activity.id).order_by('-timestamp')
+
+                for gact in groupable_activities:
+                    if activity.id in batched_actions:
+                        if gact.id not in batched_actions[activity.id]:
+                            batched_actions[activity.id].append(gact.id)
+                    else:
+                        batched_actions[activity.id] =  [gact.id]
+
+    return batched_actions
+
+
+class BatchingTestCase(ActivityBaseTestCase):
+    actstream_models = ('auth.User', 'auth.Group')
+    pages = ((0, 15), (15, 40), (40, 80))
+
+    def setUp(self):
+        super(BatchingTestCase, self).setUp()
+        self.users = [User.objects.create(username='batch%d' % i)
+                      for i in range(3)]
+        self.groups = [Group.objects.create(name='batch%d' % i)
+                       for i in range(2)]
+        self.queryset = Action.objects.order_by('-timestamp', '-id')
+
+    def populate(self, rand, count=80):
+        Action.objects.all().delete()
+        start = timezone.now() - timedelta(hours=3)
+        for i in range(count):
+            Action.objects.create(
+                actor=rand.choice(self.users),
+                verb=rand.choice(['followed', 'liked']),
+                target=rand.choice(self.users + self.groups),
+                timestamp=start + timedelta(minutes=rand.randint(0, 180)),
+                is_batchable=rand.random() < 0.6,
+                batch_time_minutes=rand.choice([None, 5, 20, 60]))
+
+    def test_matches_legacy_grouping(self):
+        as_sets = lambda mapping: dict((parent, set(children)) for
+                                       parent, children in mapping.items())
+        for seed in range(5):
+            self.populate(Random(seed))
+            legacy, grouped = {}, {}
+            for s, l in self.pages:
+                legacy_merge_action_subset_op(self.queryset, s, l, legacy,
+                                              'followed')
+                group_actions(self.queryset, list(self.queryset[s:l]), grouped,
+                              follow_verb='followed')
+                self.assertEqual(as_sets(grouped), as_sets(legacy))
+
+    def test_single_query(self):
+        self.populate(Random(0))
+        page = list(self.queryset[:40])
+        with self.assertNumQueries(1):
+            grouped = group_actions(self.queryset, page, follow_verb='followed')
+        self.assertTrue(grouped)
+        # an action is batched by a single parent
+        children = sum(grouped.values(), [])
+        self.assertEqual(len(children), len(set(children)))
+
+    def test_batch_groups(self):
+        old_batch_groups = actstream_settings.BATCH_GROUPS
+        actstream_settings.BATCH_GROUPS = True
+        try:
+            start = timezone.now() - timedelta(hours=1)
+            for user, minutes in zip(self.users + [self.groups[1]],
+                                     (0, 10, 20, 50)):
+                action.send(user, verb='liked', target=self.groups[0],
+                            is_batchable=True, batch_time_minutes=15,
+                            timestamp=start + timedelta(minutes=minutes))
+        finally:
+            actstream_settings.BATCH_GROUPS = old_batch_groups
+        latest, head, second, first = self.queryset
+        # the third action chains the first two into its batch
+        self.assertEqual(list(collapse_batches(self.queryset)), [latest, head])
+        self.assertEqual(batched_children(self.queryset, [latest, head]),
+                         {head.pk: [second.pk, first.pk]})
+
+        # a feed without the head keeps the rest of its batch together
+        feed = self.queryset.exclude(actor_object_id=head.actor_object_id,
+                                     actor_content_type=head.actor_content_type)
+        self.assertEqual(list(collapse_batches(feed)), [latest, second, first])
+        with self.assertNumQueries(1):
+            self.assertEqual(batched_children(feed, [latest, second]),
+                             {second.pk: [first.pk]})
+        self.assertEqual(batched_children(feed, [first]), {})
+
+        Action.objects.update(batch_group=None)
+        call_command('actstream_assign_batch_groups', verbosity=0,
+                     skip_validation=True)
+        self.assertEqual([a.batch_group for a in self.queryset],
+                         [None, head.pk, head.pk, head.pk])
+
+    def test_batched_tags(self):
+        start = timezone.now() - timedelta(hours=1)
+        for minutes, user in enumerate(self.users):
+            Action.objects.create(actor=user, verb='liked',
+                                  target=self.groups[0], is_batchable=True,
+                                  timestamp=start + timedelta(minutes=minutes))
+        page = list(self.queryset)
+        batched_actions = group_actions(self.queryset, page,
+                                        follow_verb='followed')
+        src = ('{% load activity_tags %}{% for action in action_list %}'
+               '{% with batched_actions|get_value_from_dict:action.id as ids %}'
+               '{% get_batched_actors ids action.id as actors %}'
+               '{% get_batched_targets ids action.id as targets %}'
+               '{{ actors|length }}/{{ targets|length }} '
+               '{% endwith %}{% endfor %}')
+        # the batches of the page and their actors and targets are loaded
+        # together, one query per model
+        with self.assertNumQueries(LTE(3)):
+            output = Template(src).render(Context({
+                'action_list': page, 'batched_actions': batched_actions}))
+        self.assertEqual(output, '2/0 0/0 0/0 ')
+
+
 class ZombieTest(ActivityBaseTestCase):
     actstream_models = ('auth.User',)
     human = 10
@@ -367,3 +1157,81 @@ class GFKManagerTestCase(TestCase):
                 actions().fetch_generic_relations('target')]
         self.assertEqual(action_actor_targets,
             action_actor_targets_fetch_generic_target)
+
+    def test_fetch_generic_relations_single_pass(self):
+        old_prefetch = actstream_settings.USE_PREFETCH
+        actstream_settings.USE_PREFETCH = False
+        try:
+            _actions = Action.objects.filter(actor_content_type=self.user_ct,
+                actor_object_id=self.user1.id)
+            # one query for the actions and one per content type
+            self.assertNumQueries(LTE(3), lambda: [(a.actor, a.target)
+                for a in _actions._clone().fetch_generic_relations()])
+            actions = _actions._clone().fetch_generic_relations()
+            self.assertNumQueries(0, lambda: [(a.actor, a.target)
+                for a in actions])
+            self.assertEqual([(a.id, a.actor, a.target) for a in actions],
+                [(a.id, a.actor, a.target) for a in _actions._clone()])
+        finally:
+            actstream_settings.USE_PREFETCH = old_prefetch
+
+
+class ObjectCacheTestCase(ActivityBaseTestCase):
+    actstream_models = ('auth.User', 'auth.Group')
+
+    def setUp(self):
+        super(ObjectCacheTestCase, self).setUp()
+        self.old_cache = actstream_settings.GFK_CACHE
+        actstream_settings.GFK_CACHE = 'memory'
+        object_cache.reset_object_cache()
+        object_cache.connect_signals()
+        self.user = User.objects.create(username='cached')
+        self.group = Group.objects.create(name='CachedGroup')
+        action.send(self.user, verb='joined', target=self.group)
+
+    def tearDown(self):
+        object_cache.reset_object_cache()
+        actstream_settings.GFK_CACHE = self.old_cache
+        super(ObjectCacheTestCase, self).tearDown()
+
+    def fetch(self):
+        return [(a.actor, a.target) for a in
+                Action.objects.all().fetch_generic_relations()]
+
+    def test_cached_objects_skip_queries(self):
+        self.assertEqual(self.fetch(), [(self.user, self.group)])
+        # only the actions themselves are queried once objects are cached
+        self.assertNumQueries(1, self.fetch)
+
+    def test_save_invalidates(self):
+        self.fetch()
+        self.group.name = 'Renamed'
+        self.group.save()
+        self.assertEqual(self.fetch()[0][1].name, 'Renamed')
+
+
+class CacheKeysTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_make_key(self):
+        key = cache_keys.make_key('batched_actions', u'John Smith')
+        self.assertTrue(key.startswith('actstream:batched_actions:%s:' %
+                                       settings.SITE_ID))
+        self.assertFalse(' ' in key)
+        self.assertNotEqual(key, cache_keys.make_key('batched_actions', 'Jo'))
+        with self.settings(SITE_ID=settings.SITE_ID + 1):
+            self.assertNotEqual(key, cache_keys.make_key('batched_actions',
+                                                         u'John Smith'))
+
+    def test_invalidate_user(self):
+        cache.set(cache_keys.user_key(1, 'batched_actions'), 'state')
+        cache.set(cache_keys.user_key(2, 'batched_actions'), 'other')
+        self.assertEqual(cache.get(cache_keys.user_key(1, 'batched_actions')),
+                         'state')
+        cache_keys.invalidate_user(1)
+        self.assertEqual(cache.get(cache_keys.user_key(1, 'batched_actions')),
+                         None)
+        self.assertEqual(cache.get(cache_keys.user_key(2, 'batched_actions')),
+                         'other')
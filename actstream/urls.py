@@ -33,10 +33,14 @@ urlpatterns = patterns('actstream.views',
         'actor', name='actstream_actor'),
     url(r'^actstream_actor_subset/(?P<content_type_id>\d+)/(?P<object_id>\d+)/(?P<sIndex>\d+)/(?P<lIndex>\d+)/$',
         'actstream_actor_subset', name='actstream_actor_subset'),
+    url(r'^actstream_actor_subset/(?P<content_type_id>\d+)/(?P<object_id>\d+)/c/(?P<cursor>[-\w]+)/(?P<limit>\d+)/$',
+        'actstream_actor_subset', name='actstream_actor_cursor'),
     url(r'^actstream_following/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$',
         'actstream_following', name='actstream_following'),
     url(r'^actstream_following_subset/(?P<content_type_id>\d+)/(?P<object_id>\d+)/(?P<sIndex>\d+)/(?P<lIndex>\d+)/$',
         'actstream_following_subset', name='actstream_following_subset'),
+    url(r'^actstream_following_subset/(?P<content_type_id>\d+)/(?P<object_id>\d+)/c/(?P<cursor>[-\w]+)/(?P<limit>\d+)/$',
+        'actstream_following_subset', name='actstream_following_cursor'),
     url(r'^actstream_rebuild_cache/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$',
         'actstream_rebuild_cache', name='actstream_rebuild_cache'),
     url(r'^actstream_actor_rebuild_cache/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$',
@@ -45,6 +49,7 @@ urlpatterns = patterns('actstream.views',
         'actstream_update_activity', name='actstream_update_activity'),
     url(r'^actstream_latest_activity_count/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$',
         'actstream_latest_activity_count', name='actstream_latest_activity_count'),
+    url(r'^actstream_events/$', 'actstream_events', name='actstream_events'),
     url(r'^actors/(?P<content_type_id>\d+)/$',
         'model', name='actstream_model'),
 
@@ -1,17 +1,25 @@
 import json
+import time
+from collections import defaultdict
 
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext, VariableDoesNotExist
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, Http404,\
+    StreamingHttpResponse
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.views.decorators.csrf import csrf_exempt
+from django.db import connection
 from django.db.models import Q
 from django.conf import settings
 
-from actstream import actions, models
+from actstream import actions, batching, cache_keys, cursors, feed_plan,\
+    identity_map, models, pubsub, stream_cache, watermark
+from actstream import settings as actstream_settings
+from actstream.exceptions import BadCursor
+from actstream.managers import _column
 from actstream.models import Follow
 from django.core.cache import cache
 from actstream import action
@@ -28,7 +36,6 @@ except ImportError:
     now = datetime.now
 import itertools
 
-ACTIVITY_DEFAULT_BATCH_TIME = 30
 
 def respond(request, code):
     """
@@ -68,25 +75,48 @@ def stream(request):
     }, context_instance=RequestContext(request))
 
 
+FOLLOWS_PAGE_SIZE = 50
+
+
+def _follow_page(request, sequence):
+    """
+    Returns the page of a ``FollowSequence`` following the follow id given
+    in the ``after`` GET parameter, and the ``after`` of the next page.
+    """
+    after = request.GET.get('after')
+    try:
+        after = int(after) if after else None
+    except ValueError:
+        raise Http404
+    return sequence.page(after, FOLLOWS_PAGE_SIZE)
+
+
 def followers(request, content_type_id, object_id):
     """
     Creates a listing of ``User``s that follow the actor defined by
-    ``content_type_id``, ``object_id``.
+    ``content_type_id``, ``object_id``, one page at a time.
     """
     ctype = get_object_or_404(ContentType, pk=content_type_id)
     actor = get_object_or_404(ctype.model_class(), pk=object_id)
+    sequence = models.lazy_followers(actor)
+    page, next_after = _follow_page(request, sequence)
     return render_to_response(('actstream/followers.html', 'activity/followers.html'), {
-        'followers': models.followers(actor), 'actor': actor
+        'followers': page, 'actor': actor, 'next_after': next_after,
+        'followers_count': len(sequence),
     }, context_instance=RequestContext(request))
 
 
 def following(request, user_id):
     """
-    Returns a list of actors that the user identified by ``user_id`` is following (eg who im following).
+    Returns a list of actors that the user identified by ``user_id`` is following (eg who im following),
+    one page at a time.
     """
     user = get_object_or_404(User, pk=user_id)
+    sequence = models.lazy_following(user)
+    page, next_after = _follow_page(request, sequence)
     return render_to_response(('actstream/following.html', 'activity/following.html'), {
-        'following': models.following(user), 'user': user
+        'following': page, 'user': user, 'next_after': next_after,
+        'following_count': len(sequence),
     }, context_instance=RequestContext(request))
 
 
@@ -110,33 +140,117 @@ def detail(request, action_id):
     }, context_instance=RequestContext(request))
 
 
+def _feed_followable(model):
+    """
+    Returns True if the actions on or targeting the objects of ``model``
+    enter the following feed of the users following them with both actstream
+    and django-follow. Users and blog posts are left out.
+    """
+    if model is None or issubclass(model, User) or \
+            model.__name__ == 'BlogPost':
+        return False
+    try:
+        _Follow.objects.fname(model)
+    except KeyError:
+        # not registered with django-follow
+        return False
+    return True
+
+
+def _own_feed_verbs():
+    """
+    Returns the verbs of the user's own actions shown in their following feed
+    """
+    return [settings.SAID_VERB, settings.SHARE_VERB, settings.REVIEW_POST_VERB,
+            settings.DEAL_POST_VERB, settings.WISH_POST_VERB]
+
+
+def _followed_content_types(actor):
+    """
+    Returns the ids of the content types of the objects ``actor`` follows
+    with actstream whose actions enter its feed through django-follow (see
+    ``_feed_followable``), with one query.
+    """
+    return sorted(content_type_id for content_type_id in
+        Follow.objects.filter(user=actor).order_by().values_list(
+            'content_type', flat=True).distinct()
+        if _feed_followable(
+            ContentType.objects.get_for_id(content_type_id).model_class()))
+
+
+def _django_follow_exists(actor, content_type_id, field):
+    """
+    Returns the SQL and parameters of a correlated ``EXISTS`` clause matching
+    the actions whose ``field`` (``target`` or ``action_object``) is an object
+    of ``content_type_id`` that ``actor`` follows with actstream and has
+    followed with django-follow since the action was done.
+    """
+    model = ContentType.objects.get_for_id(content_type_id).model_class()
+    followed = _column(_Follow, _Follow.objects.fname(model))
+    # django-follow keys are integers, actstream object ids are text
+    followed = 'CAST(%s AS %s)' % (
+        followed, 'CHAR' if connection.vendor == 'mysql' else 'VARCHAR')
+    action_column = lambda name: _column(models.Action, name % field)
+    sql = ('%s = %%s AND EXISTS (SELECT 1 FROM %s, %s WHERE %s = %%s AND '
+           '%s = %%s AND %s = %s AND %s = %s AND %s = %s AND %s <= %s)' % (
+        action_column('%s_content_type'),
+        connection.ops.quote_name(Follow._meta.db_table),
+        connection.ops.quote_name(_Follow._meta.db_table),
+        _column(Follow, 'user'), _column(Follow, 'content_type'),
+        _column(Follow, 'object_id'), action_column('%s_object_id'),
+        _column(_Follow, 'user'), _column(Follow, 'user'),
+        followed, _column(Follow, 'object_id'),
+        _column(_Follow, 'datetime'), _column(models.Action, 'timestamp')))
+    return sql, [content_type_id, actor.pk, content_type_id]
+
+
+def _following_feed(actor, content_type_ids):
+    """
+    Returns the public actions of ``actor``, of the actors it follows since
+    it followed them and, for the objects of the ``content_type_ids``
+    returned by ``_followed_content_types`` it also follows with
+    django-follow, the actions on or targeting them since then. Follows are
+    matched with correlated ``EXISTS`` clauses, so the query has the same
+    size however many objects are followed.
+    """
+    activity = models.Action.objects.public(
+        actor_content_type=ContentType.objects.get_for_model(actor),
+        actor_object_id=actor.pk,
+    ) | models.Action.objects.followed_since(actor)
+
+    clauses = [_django_follow_exists(actor, content_type_id, field)
+               for content_type_id in content_type_ids
+               for field in ('target', 'action_object')]
+    if clauses:
+        activity = activity | models.Action.objects.public().extra(
+            where=['(%s)' % ' OR '.join(sql for sql, params in clauses)],
+            params=sum([params for sql, params in clauses], []))
+    return activity
+
+
+def _feed_plan(request, actor):
+    """
+    Returns the plan of the follower feed of ``actor`` for the current user:
+    its followed ``content_types`` and the ``blog_posts`` ids followed by the
+    user, by content type, whose reviews are left out. Plans are cached
+    between polls (see ``actstream.feed_plan``).
+    """
+    def build():
+        followed_blog_posts = utils.get_following_vendors_for_user(request.user) or ()
+        blog_posts = defaultdict(list)
+        for blogpost in followed_blog_posts:
+            blog_posts[ContentType.objects.get_for_model(blogpost).pk].append(blogpost.id)
+        return {
+            'content_types': _followed_content_types(actor),
+            'blog_posts': dict(blog_posts),
+        }
+    return feed_plan.get_plan(request.user, actor, build)
+
+
 def actstream_following(request, content_type_id, object_id):
-    from itertools import chain
-    import operator
     ctype = get_object_or_404(ContentType, pk=content_type_id)
     actor = get_object_or_404(ctype.model_class(), pk=object_id)
-    activity = actor.actor_actions.public()
-
-    for followedActor in Follow.objects.following(user=actor):
-        target_content_type = ContentType.objects.get_for_model(followedActor)
-        prevFollowActions = Action.objects.all().filter(actor_content_type=ctype, actor_object_id=object_id,verb=settings.FOLLOW_VERB, target_content_type=target_content_type, target_object_id = followedActor.pk ).order_by('-pk')
-        followAction = None
-        if prevFollowActions:
-            followAction =  prevFollowActions[0]
-        if followAction:
-            stream = followedActor.actor_actions.public(timestamp__gte = followAction.timestamp)
-            activity = activity | stream
-
-        if not isinstance(followedActor, User):
-            _follow = _Follow.objects.get_follows(followedActor)
-            if _follow:
-                follow = _follow.get(user=actor)
-                if follow:
-                    stream = models.action_object_stream(followedActor, timestamp__gte = follow.datetime )
-                    activity = activity | stream
-                    stream = models.target_stream(followedActor, timestamp__gte = follow.datetime )
-                    activity = activity | stream
-    activity =  activity.order_by('-timestamp')
+    activity = _following_feed(actor, _followed_content_types(actor)).order_by('-timestamp')
 
     return render_to_response(('actstream/actor_feed.html', 'activity/actor_feed.html'), {
        'action_list': activity, 'actor': actor,
@@ -145,164 +259,183 @@ def actstream_following(request, content_type_id, object_id):
 
 
 def get_actions_following(request, content_type_id, object_id):
-    activity_queryset = None
-    ctype 			  = get_object_or_404(ContentType, pk=content_type_id)
-    actor 			  = get_object_or_404(ctype.model_class(), pk=object_id)
-
-    if activity_queryset is None:
-        activity_queryset = actor.actor_actions.public()
-
-        for followedObject in Follow.objects.following(user=actor):
-            if followedObject:
-                obj_content_type 	  = ContentType.objects.get_for_model(followedObject)
-                followObject     	  = Follow.objects.get(user=actor, content_type=obj_content_type, object_id=followedObject.pk )
-                if followObject:
-                    stream 		 	  = followedObject.actor_actions.public(timestamp__gte=followObject.started)
-                    activity_queryset = activity_queryset | stream
-
-                if not isinstance(followedObject, User) and not isinstance(followedObject, BlogPost):
-                    _follow    = _Follow.objects.get_follows(followedObject)
-                    if _follow:
-                        follow = _follow.get(user=actor)
-                        if follow:
-                            stream 			  = models.action_object_stream(followedObject, timestamp__gte = follow.datetime )
-                            activity_queryset = activity_queryset | stream
-                            stream 			  = models.target_stream(followedObject, timestamp__gte = follow.datetime )
-                            activity_queryset = activity_queryset | stream
-
-        allowed_verbs_for_user_in_common_feed = [settings.SAID_VERB, settings.SHARE_VERB, settings.REVIEW_POST_VERB, settings.DEAL_POST_VERB, settings.WISH_POST_VERB]
-        user_ctype = ContentType.objects.get_for_model(request.user)
-        activity_queryset = activity_queryset.exclude(~Q(verb__in=allowed_verbs_for_user_in_common_feed) & Q(actor_content_type=user_ctype, actor_object_id=request.user.id) )
-
-        followed_blog_posts = utils.get_following_vendors_for_user(request.user)
-
-        blogPostContentType = ContentType.objects.get_for_model(BlogPost)
-        if followed_blog_posts:
-            activity_queryset = activity_queryset.exclude(Q(verb=settings.REVIEW_POST_VERB) & Q(action_object_content_type=blogPostContentType) & Q(action_object_object_id__in=[blogpost.id for blogpost in followed_blog_posts]))
-
-        activity_queryset = activity_queryset.order_by('-timestamp')
-
-    return activity_queryset
-
-def merge_action_subset_op(request, activity_queryset, sIndex, lIndex):
-    activities = activity_queryset[sIndex:lIndex]
-
-    if activities and len(activities) > 0 and 'last_processed_action' not in request.session:
-    	request.session['last_processed_action'] = activities[0].id
-
-    batched_actions = cache.get(request.user.username+"batched_actions")
-    if not batched_actions:
-        batched_actions = dict()
-
-    for activity in activities:
-        if activity.is_batchable:
-            is_batched=False
+    ctype = get_object_or_404(ContentType, pk=content_type_id)
+    actor = get_object_or_404(ctype.model_class(), pk=object_id)
 
-            for value in batched_actions.values():
-                if activity.id in value:
-                    is_batched = True
+    plan = _feed_plan(request, actor)
+    activity_queryset = _following_feed(actor, plan['content_types'])
 
-            if not is_batched:
-                batch_minutes = activity.batch_time_minutes
-                if not batch_minutes:
-                    batch_minutes = ACTIVITY_DEFAULT_BATCH_TIME
+    allowed_verbs_for_user_in_common_feed = _own_feed_verbs()
+    user_ctype = ContentType.objects.get_for_model(request.user)
+    activity_queryset = activity_queryset.exclude(~Q(verb__in=allowed_verbs_for_user_in_common_feed) & Q(actor_content_type=user_ctype, actor_object_id=request.user.id) )
 
-                cutoff_time = activity.timestamp - timedelta(minutes=batch_minutes)
+    for blogPostContentType, blog_post_ids in plan['blog_posts'].items():
+        activity_queryset = activity_queryset.exclude(Q(verb=settings.REVIEW_POST_VERB) & Q(action_object_content_type=blogPostContentType) & Q(action_object_object_id__in=blog_post_ids))
 
-                groupable_activities = None
+    return activity_queryset.order_by('-timestamp')
 
-                if activity.verb == settings.FOLLOW_VERB:
-                    actor_content_type   = ContentType.objects.get_for_model(activity.actor)
-                    groupable_activities = activity_queryset.filter(timestamp__gte=cutoff_time,timestamp__lte=activity.timestamp, actor_content_type=actor_content_type, actor_object_id=activity.actor.pk, verb=activity.verb,target_content_type=activity.target_content_type ).exclude(id=activity.id).order_by('-timestamp')
 
-                else:
-                    actor_content_type   = ContentType.objects.get_for_model(activity.actor)
-                    groupable_activities = activity_queryset.filter(timestamp__gte=cutoff_time, timestamp__lte=activity.timestamp, actor_content_type=actor_content_type, verb=activity.verb,target_content_type=activity.target_content_type, target_object_id=activity.target.id ).exclude(id=activity.id).order_by('-timestamp')
+def feed_follower_ids(action):
+    """
+    Returns the set of ids of the users whose following feed
+    (``get_actions_following``) contains the given action, applying its
+    rules to the one action instead of the whole feed.
+    """
+    if not action.public or action.state != 1:
+        return set()
+    recipients = set(Follow.objects.filter(
+        content_type=action.actor_content_type_id,
+        object_id=action.actor_object_id,
+        started__lte=action.timestamp,
+    ).values_list('user', flat=True))
+
+    for field in ('target', 'action_object'):
+        content_type_id = getattr(action, '%s_content_type_id' % field)
+        object_id = getattr(action, '%s_object_id' % field)
+        if content_type_id is None or object_id is None:
+            continue
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if not _feed_followable(model):
+            continue
+        recipients.update(_Follow.objects.filter(**{
+            _Follow.objects.fname(model): object_id,
+            'user__in': Follow.objects.filter(content_type=content_type_id,
+                                              object_id=object_id
+                                              ).values('user'),
+            'datetime__lte': action.timestamp,
+        }).values_list('user', flat=True))
+
+    if action.actor_content_type_id == \
+            ContentType.objects.get_for_model(User).pk:
+        actor_id = int(action.actor_object_id)
+        if action.verb in _own_feed_verbs():
+            recipients.add(actor_id)
+        else:
+            recipients.discard(actor_id)
+
+    if action.verb == settings.REVIEW_POST_VERB and \
+            action.action_object_content_type_id is not None:
+        model = ContentType.objects.get_for_id(
+            action.action_object_content_type_id).model_class()
+        if model is not None and model.__name__ == 'BlogPost':
+            # the reviews of the blog posts a user follows are left out
+            recipients.difference_update(_Follow.objects.filter(**{
+                _Follow.objects.fname(model): action.action_object_object_id,
+            }).values_list('user', flat=True))
+    return recipients
+
+def merge_action_subset_op(request, activity_queryset, sIndex, lIndex, activities=None):
+    """
+    Returns the mapping of the batchable actions of the
+    ``activity_queryset[sIndex:lIndex]`` page to the actions they batch,
+    extending the mapping cached for the previous pages of the user.
+    ``activities`` is the page when it was already fetched.
+    """
+    if activities is None:
+        activities = list(activity_queryset[sIndex:lIndex])
 
-                for gact in groupable_activities:
-                    if activity.id in batched_actions:
-                        if gact.id not in batched_actions[activity.id]:
-                            batched_actions[activity.id].append(gact.id)
-                    else:
-                        batched_actions[activity.id] =  [gact.id]
+    if activities and 'last_processed_action' not in request.session:
+        request.session['last_processed_action'] = activities[0].id
 
-    return batched_actions
+    batched_actions = cache.get(cache_keys.user_key(request.user, 'batched_actions')) or dict()
+    if actstream_settings.BATCH_GROUPS:
+        batched_actions.update(batching.batched_children(activity_queryset, activities))
+        return batched_actions
+    return batching.group_actions(activity_queryset, activities, batched_actions)
 
-def actstream_following_subset(request, content_type_id, object_id, sIndex, lIndex):
+def actstream_following_subset(request, content_type_id, object_id, sIndex=0, lIndex=0, cursor=None, limit=None):
+    """
+    Page of the feed of the actor defined by ``content_type_id``,
+    ``object_id``. Pages are selected either by ``sIndex``/``lIndex`` offsets
+    or by the opaque ``cursor`` returned with the previous page (in the URL or
+    as a ``cursor`` GET parameter), which seeks instead of offsetting.
+    """
 
     ctype = get_object_or_404(ContentType, pk=content_type_id)
     actor = get_object_or_404(ctype.model_class(), pk=object_id)
 
     activity_queryset = get_actions_following(request, content_type_id, object_id)
 
-    s = (int)(""+sIndex)
-    l = (int)(""+lIndex)
-    activities = activity_queryset[s:l]
-
-    batched_actions = merge_action_subset_op(request, activity_queryset, s, l)
-    cache.set(request.user.username+"batched_actions", batched_actions)
-
-    activity_count = 0
-    if activity_queryset:
-        activity_count = activity_queryset.count()
-
-    if 'last_activity_count' not in request.session:
-        request.session['last_activity_count'] = activity_count
-
-    if activities and len(activities) > 0 and s == 0:
-        request.session['last_processed_action'] = activities[0].id
-
-    return render_to_response(('actstream/actor_feed.html', 'activity/actor_feed.html'), {
+    s = int(sIndex)
+    l = int(lIndex)
+    cursor = cursor or request.GET.get('cursor')
+    if cursor:
+        try:
+            activity_queryset = cursors.seek(activity_queryset, before=cursor)
+        except BadCursor:
+            raise Http404
+        l = _page_size(request, limit, l - s)
+        s = 0
+    # with batch groups recorded at write time the batched actions are left
+    # out of the pages instead of being hidden by the template
+    page_queryset = activity_queryset
+    if actstream_settings.BATCH_GROUPS:
+        page_queryset = batching.collapse_batches(activity_queryset)
+    activities = list(page_queryset[s:l])
+
+    batched_actions = merge_action_subset_op(request, activity_queryset, s, l, activities)
+    cache.set(cache_keys.user_key(request.user, 'batched_actions'), batched_actions)
+
+    if not cursor:
+        activity_count = 0
+        if page_queryset:
+            activity_count = page_queryset.count()
+
+        if 'last_activity_count' not in request.session:
+            request.session['last_activity_count'] = activity_count
+
+        if activities and len(activities) > 0 and s == 0:
+            request.session['last_processed_action'] = activities[0].id
+
+    return _render_feed_page(request, {
        'action_list': activities,
        'actor': actor,
        'ctype': ctype,
        'sIndex':s,
        'batched_actions':batched_actions,
-    }, context_instance=RequestContext(request))
+       'next_cursor': _next_cursor(activities, l - s),
+    })
 
 def actstream_latest_activity_count(request, content_type_id, object_id):
-    batched_actions   = dict()
-    ctype             = get_object_or_404(ContentType, pk=content_type_id)
-    actor 			  = get_object_or_404(ctype.model_class(), pk=object_id)
-
-    activity_queryset = get_actions_following(request, content_type_id, object_id)
-
+    """
+    Returns the number of feed actions newer than the last one shown to the
+    user, up to ``NEW_ACTIVITY_COUNT_LIMIT`` (``display`` then reads "99+").
+    Polls are answered from the latest action watermark while nothing was
+    saved since, and otherwise with one capped count.
+    """
+    limit = actstream_settings.NEW_ACTIVITY_COUNT_LIMIT
     last_processed_id = request.session.get('last_processed_action', -1)
+    if last_processed_id < 0 or watermark.latest_action_id() <= last_processed_id:
+        return HttpResponse(json.dumps(dict(success=True, count=0, display='0')))
 
-    activity_qs_unprocessed = None
-
-    if last_processed_id >= 0:
-        """
-            Feeds for like/unfollow are excluded in incremental update as user can keep toggling them due to which 
-            possibility of duplciation arises.
-        """
-        disallowed_verbs_for_incremental_feed = [settings.WISH_LIKE_VERB, settings.DEAL_LIKE_VERB, settings.POST_LIKE_VERB, \
-    											 settings.ALBUM_LIKE_WISH, settings.REVIEW_COMMENT_LIKE_VERB, settings.ALBUM_COMMENT_LIKE_VERB, \
-    											 settings.IMAGE_COMMENT_LIKE_VERB, settings.DEAL_COMMENT_LIKE_VERB, settings.WISH_COMMENT_LIKE_VERB,\
-    											 settings.POST_COMMENT_LIKE_VERB, settings.REVIEW_LIKE_VERB, settings.PHOTO_LIKE_VERB,\
-    											 settings.FOLLOW_VERB, settings.UNFOLLOW_VERB ]
-
-        activity_qs_unprocessed = activity_queryset.filter(id__gt=last_processed_id).exclude(Q(verb__in=disallowed_verbs_for_incremental_feed))
+    activity_queryset = get_actions_following(request, content_type_id, object_id)
 
-        if activity_qs_unprocessed and activity_qs_unprocessed.count() > 0:
-            batched_actions = merge_action_subset_op(request, activity_qs_unprocessed, 0, activity_qs_unprocessed.count()-1)
+    """
+        Feeds for like/unfollow are excluded in incremental update as user can keep toggling them due to which 
+        possibility of duplciation arises.
+    """
+    disallowed_verbs_for_incremental_feed = [settings.WISH_LIKE_VERB, settings.DEAL_LIKE_VERB, settings.POST_LIKE_VERB, \
+                                             settings.ALBUM_LIKE_WISH, settings.REVIEW_COMMENT_LIKE_VERB, settings.ALBUM_COMMENT_LIKE_VERB, \
+                                             settings.IMAGE_COMMENT_LIKE_VERB, settings.DEAL_COMMENT_LIKE_VERB, settings.WISH_COMMENT_LIKE_VERB,\
+                                             settings.POST_COMMENT_LIKE_VERB, settings.REVIEW_LIKE_VERB, settings.PHOTO_LIKE_VERB,\
+                                             settings.FOLLOW_VERB, settings.UNFOLLOW_VERB ]
+
+    activity_qs_unprocessed = activity_queryset.filter(id__gt=last_processed_id).exclude(Q(verb__in=disallowed_verbs_for_incremental_feed))
+
+    if actstream_settings.BATCH_GROUPS:
+        # batched actions are left out in SQL, but for the batches headed
+        # outside of the feed; count() would drop the slice, so only the
+        # first limit + 1 ids are read
+        activity_count = len(batching.collapse_batches(
+            activity_qs_unprocessed).values_list('id', flat=True)[:limit + 1])
+    else:
+        activities = list(activity_qs_unprocessed[:limit + 1])
+        batched_actions = merge_action_subset_op(request, activity_qs_unprocessed, 0, limit + 1, activities)
+        batched_ids = set(itertools.chain(*batched_actions.values()))
+        activity_count = len([activity for activity in activities if activity.id not in batched_ids])
 
-        try:
-            user = request.user
-
-            action_id_maps = batched_actions
-            action_id_list = []
-            if action_id_maps:
-                action_id_list = action_id_maps.values()
-        except VariableDoesNotExist:
-            return ''
-        batched_ids = list(itertools.chain(*action_id_list))
-        activity_qs_unprocessed = activity_qs_unprocessed.exclude(id__in=batched_ids)
-
-    activity_count = 0
-    if activity_qs_unprocessed:
-        activity_count = activity_qs_unprocessed.count()
-    return HttpResponse(json.dumps(dict(success=True, count=activity_count)))
+    display = '%d+' % limit if activity_count > limit else str(activity_count)
+    return HttpResponse(json.dumps(dict(success=True, count=min(activity_count, limit), display=display)))
 
 def actstream_update_activity(request, content_type_id, object_id):
     batched_actions   = dict()
@@ -334,21 +467,21 @@ def actstream_update_activity(request, content_type_id, object_id):
 
         if activity_qs_unprocessed and activity_qs_unprocessed.count() > 0:
             batched_actions = merge_action_subset_op(request, activity_qs_unprocessed, 0, activity_qs_unprocessed.count()-1)
-            prev_batched_actions = cache.get(request.user.username+"batched_actions")
+            prev_batched_actions = cache.get(cache_keys.user_key(request.user, 'batched_actions'))
             if prev_batched_actions:
     	        combined_batch_actions = prev_batched_actions.copy()
     	        combined_batch_actions.update(batched_actions)
             else:
     	        combined_batch_actions = batched_actions
 
-            cache.set(request.user.username+"batched_actions", combined_batch_actions)
-        return render_to_response(('actstream/actor_feed.html', 'activity/actor_feed.html'), {
+            cache.set(cache_keys.user_key(request.user, 'batched_actions'), combined_batch_actions)
+        return _render_feed_page(request, {
            'action_list': activity_qs_unprocessed,
            'actor': actor,
            'ctype': ctype,
            'sIndex':request.session.get('last_activity_count', 0),
            'batched_actions':batched_actions,
-        }, context_instance=RequestContext(request))
+        })
     else:
     	"""
     		If last_action_id is not set but there are some unprocessed initial activities,process them.
@@ -356,16 +489,65 @@ def actstream_update_activity(request, content_type_id, object_id):
     	if activity_queryset:
             request.session['last_processed_action'] = activity_queryset[0].id
             request.session['last_activity_count']  = activity_queryset.count()
-            return render_to_response(('actstream/actor_feed.html', 'activity/actor_feed.html'), {
+            return _render_feed_page(request, {
                'action_list': activity_queryset,
                'actor': actor,
                'ctype': ctype,
                'sIndex':request.session.get('last_activity_count', 0),
                'batched_actions':batched_actions,
-            }, context_instance=RequestContext(request))
+            })
     	else:
     	    return HttpResponse(json.dumps(dict(success=True, message="No New Actions")))
 
+# seconds between the comments keeping an idle event stream open
+EVENTS_KEEPALIVE = 15
+
+
+@login_required
+def actstream_events(request):
+    """
+    Pushes the ids of the actions entering the feed of the current user as
+    server-sent events, as they are saved (see ``actstream.pubsub``). The
+    connection is held ``EVENTS_TIMEOUT`` seconds, then ``EventSource``
+    reconnects and resumes after its ``Last-Event-ID``.
+
+    With ``?poll=1`` it long-polls instead: it waits up to ``EVENTS_TIMEOUT``
+    seconds for new actions and returns their ids as JSON, along with the
+    ``last_event_id`` GET parameter of the next poll.
+    """
+    if not pubsub.is_enabled():
+        raise Http404
+    backend = pubsub.get_backend()
+    channel = pubsub.user_channel(request.user.pk)
+    timeout = actstream_settings.EVENTS_TIMEOUT
+    last_event_id = request.META.get('HTTP_LAST_EVENT_ID',
+                                     request.GET.get('last_event_id'))
+    try:
+        last_event_id = int(last_event_id) if last_event_id else backend.last_id(channel)
+    except ValueError:
+        raise Http404
+
+    if request.GET.get('poll'):
+        messages = backend.fetch(channel, last_event_id, timeout)
+        if messages:
+            last_event_id = messages[-1][0]
+        return HttpResponse(json.dumps(dict(success=True, last_event_id=last_event_id,
+                                            actions=[action_id for number, action_id in messages])))
+
+    def events(after):
+        deadline = time.time() + timeout
+        yield 'retry: 1000\n\n'
+        while time.time() < deadline:
+            messages = backend.fetch(channel, after, min(deadline - time.time(), EVENTS_KEEPALIVE))
+            if not messages:
+                yield ': keepalive\n\n'
+            for after, action_id in messages:
+                yield 'id: %d\ndata: %s\n\n' % (after, action_id)
+
+    response = StreamingHttpResponse(events(last_event_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
 def actstream_rebuild_cache(request, content_type_id, object_id):
     if 'last_processed_action' in request.session:
     	del request.session['last_processed_action']
@@ -373,6 +555,9 @@ def actstream_rebuild_cache(request, content_type_id, object_id):
     if 'last_activity_count' in request.session:
     	request.session['last_activity_count'] = -1
 
+    # drops the batches and every other cached feed state of the user
+    cache_keys.invalidate_user(request.user)
+
     return HttpResponse(json.dumps(dict(success=True, message="Cache Updated")))
 
 def actstream_actor_rebuild_cache(request, content_type_id, object_id):
@@ -380,8 +565,8 @@ def actstream_actor_rebuild_cache(request, content_type_id, object_id):
     import operator
     ctype = get_object_or_404(ContentType, pk=content_type_id)
     actor = get_object_or_404(ctype.model_class(), pk=object_id)
-    activity = models.actor_stream(actor).order_by('-timestamp')
-    cache.set(actor.username+"perso", activity)
+    stream_cache.invalidate_actor(actor)
+    stream_cache.get_entries(actor)
     return HttpResponse(json.dumps(dict(success=True, message="Cache Updated")))
 
 def actor(request, content_type_id, object_id):
@@ -398,35 +583,79 @@ def actor(request, content_type_id, object_id):
         'ctype': ctype
     }, context_instance=RequestContext(request))
 
+def _page_size(request, limit, default):
+    """
+    Returns the number of actions of a page requested by cursor, from the
+    ``limit`` of the URL or GET parameters, up to ``MAX_PAGE_SIZE``. Raises
+    ``Http404`` if it is not a positive number.
+    """
+    try:
+        page_size = int(limit or request.GET.get('limit', default))
+    except (TypeError, ValueError):
+        raise Http404
+    if page_size <= 0:
+        raise Http404
+    return min(page_size, actstream_settings.MAX_PAGE_SIZE)
+
+def _next_cursor(activities, page_size):
+    """
+    Returns the cursor of the page following ``activities``, or None when it
+    was the last page.
+    """
+    if activities and len(activities) >= page_size:
+        return cursors.encode_cursor(activities[-1])
+    return None
+
+def _render_feed_page(request, context):
+    """
+    Renders a page of a feed, exposing its ``next_cursor`` in the
+    ``X-Actstream-Next-Cursor`` response header as well. The share counts
+    and share permissions of the page are preloaded for the share tags and
+    its actions registered in the request's identity map.
+    """
+    context['action_list'] = Action.objects.preload_shares(
+        context['action_list'], request.user)
+    identity_map.add_objects(context['action_list'])
+    response = render_to_response(('actstream/actor_feed.html', 'activity/actor_feed.html'),
+        context, context_instance=RequestContext(request))
+    if context.get('next_cursor'):
+        response['X-Actstream-Next-Cursor'] = context['next_cursor']
+    return response
+
 def json_error_response(error_message):
     return HttpResponse(json.dumps(dict(success=False,
                                               error_message=error_message)))
 
-def actstream_actor_subset(request, content_type_id, object_id, sIndex, lIndex):
+def actstream_actor_subset(request, content_type_id, object_id, sIndex=0, lIndex=0, cursor=None, limit=None):
     """
     ``Actor`` focused activity stream for actor defined by ``content_type_id``,
-    ``object_id``.
+    ``object_id``. Paged like ``actstream_following_subset``.
     """
     import operator
 
     ctype = get_object_or_404(ContentType, pk=content_type_id)
     actor = get_object_or_404(ctype.model_class(), pk=object_id)
 
-    activity = cache.get(actor.username+"perso")
-
-    if activity is None:
-        activity = models.actor_stream(actor).order_by('-timestamp')
-        cache.set(actor.username+"perso", activity)
-        #return json_error_response("hellooo")
-    s = (int)(""+sIndex)
-    l = (int)(""+lIndex)
+    s = int(sIndex)
+    l = int(lIndex)
+    cursor = cursor or request.GET.get('cursor')
 
-    activity = activity[s:l]
+    if cursor:
+        l = _page_size(request, limit, l - s)
+        s = 0
+        try:
+            activity = models.actor_stream(actor, _before=cursor, _limit=l)
+        except BadCursor:
+            raise Http404
+    else:
+        activity = stream_cache.actor_page(actor, s, l)
+    activity = list(activity)
 
-    return render_to_response(('actstream/actor_feed.html', 'activity/actor_feed.html'), {
+    return _render_feed_page(request, {
        'action_list': activity, 'actor': actor,
-       'ctype': ctype, 'sIndex':s
-    }, context_instance=RequestContext(request))
+       'ctype': ctype, 'sIndex':s,
+       'next_cursor': _next_cursor(activity, l - s),
+    })
 
 
 def model(request, content_type_id):
@@ -0,0 +1,65 @@
+"""
+Watermark of the latest saved action.
+
+The id of the newest action is kept in Django's cache and raised as actions
+are saved, so a feed poll learns from a single cache read that nothing was
+saved since the last action it showed, without querying the feed.
+
+The watermark is global: any saved action, followed or not, sends the next
+poll of every feed to the database, which then gives the actual count.
+
+It is only ever raised, with ``cache.add`` and ``cache.incr``, so concurrent
+saves can not lower it. Racing increments may push it past the newest id,
+which only costs polls a feed query until it expires after ``TIMEOUT``
+seconds and is read back from the database.
+"""
+from django.core.cache import cache
+
+from actstream import cache_keys
+
+TIMEOUT = 60
+
+
+def cache_key():
+    return cache_keys.make_key('watermark', 'latest_action')
+
+
+def latest_action_id():
+    """
+    Returns the id of the newest action, 0 when there is none
+    """
+    from actstream.models import Action
+
+    value = cache.get(cache_key())
+    if value is None:
+        ids = list(Action.objects.order_by('-id').values_list('id', flat=True)[:1])
+        value = ids[0] if ids else 0
+        cache.add(cache_key(), value, TIMEOUT)
+    return value
+
+
+def raise_to(action):
+    """
+    Raises the watermark to a newly saved action
+    """
+    key = cache_key()
+    while not cache.add(key, action.pk, TIMEOUT):
+        current = cache.get(key)
+        if current is None:
+            # expired in between, try adding it again
+            continue
+        if current >= action.pk:
+            return
+        try:
+            cache.incr(key, action.pk - current)
+        except ValueError:
+            continue
+        return
+
+
+def action_saved(sender, instance, created=False, raw=False, **kwargs):
+    """
+    Signal handler raising the watermark to the created actions
+    """
+    if created and not raw:
+        raise_to(instance)
@@ -0,0 +1,58 @@
+"""
+Shared setup for the actstream benchmarks.
+
+Configures a throwaway Django project backed by an in-memory SQLite database
+with actstream installed, so every benchmark can be run directly::
+
+    python benchmarks/bench_gfk.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DEBUG=True,
+        DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('ACTSTREAM_BENCH_DB', ':memory:'),
+        }},
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sites',
+            'actstream',
+        ),
+        SITE_ID=1,
+        ACTSTREAM_SETTINGS={
+            'MODELS': ('auth.user', 'auth.group', 'auth.permission',
+                       'sites.site', 'contenttypes.contenttype'),
+        },
+    )
+
+from django.core.management import call_command
+from django.db import connection, reset_queries
+
+
+def setup_database():
+    call_command('syncdb', interactive=False, verbosity=0)
+
+
+def measure(label, func, repeat=3):
+    """
+    Runs ``func`` ``repeat`` times and prints the best wall time together with
+    the number of queries of one run.
+    """
+    best, queries = None, None
+    for _ in range(repeat):
+        reset_queries()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        queries = len(connection.queries)
+        best = elapsed if best is None else min(best, elapsed)
+    print('%-45s %6d queries %9.3fs' % (label, queries, best))
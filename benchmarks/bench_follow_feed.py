@@ -0,0 +1,90 @@
+"""
+Benchmark of the user stream of a user following 5k of 10k users, over 1M
+actions spread over 30 days.
+
+Compares ``Action.objects.user``, which loads the follows and ORs lists of
+followed ids, with ``Action.objects.user_since``, which matches the follows
+since they started with correlated ``EXISTS`` clauses. Populating the
+database takes a few minutes.
+"""
+import random
+from datetime import timedelta
+
+from base import setup_database, measure
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.db import DatabaseError
+from django.utils import timezone
+
+from actstream.models import Action, Follow
+
+USERS = 10000
+FOLLOWS = 5000
+ACTIONS = 1000000
+# actions built per bulk_create call; Django further splits each insert to
+# stay within the backend's limits (500 rows or 999 variables on SQLite)
+BATCH_SIZE = 500
+
+
+def populate():
+    Site.objects.get_or_create(pk=1, defaults={'domain': 'example.com',
+                                               'name': 'example.com'})
+    User.objects.bulk_create([User(username='user%d' % i)
+                              for i in range(USERS)])
+    user_ids = list(User.objects.values_list('pk', flat=True))
+    user_type = ContentType.objects.get_for_model(User)
+    random.seed(0)
+    start = timezone.now() - timedelta(days=30)
+    reader = User.objects.get(username='user0')
+    Follow.objects.bulk_create([
+        Follow(user=reader, content_type=user_type, object_id=pk,
+               actor_only=random.random() < 0.5,
+               started=start + timedelta(seconds=random.randint(0, 30 * 86400)))
+        for pk in random.sample(user_ids[1:], FOLLOWS)
+    ])
+    for offset in range(0, ACTIONS, BATCH_SIZE):
+        Action.objects.bulk_create([
+            Action(actor_content_type=user_type,
+                   actor_object_id=random.choice(user_ids),
+                   verb='benchmarked',
+                   target_content_type=user_type,
+                   target_object_id=random.choice(user_ids),
+                   timestamp=start + timedelta(
+                       seconds=random.randint(0, 30 * 86400)))
+            for _ in range(min(BATCH_SIZE, ACTIONS - offset))
+        ])
+    return reader
+
+
+def page(stream, reader):
+    def run():
+        try:
+            list(stream(reader, _limit=30))
+        except DatabaseError as e:
+            # e.g. too many SQL variables for the follow lists
+            print('failed: %s' % e)
+    return run
+
+
+def count(stream, reader):
+    def run():
+        try:
+            stream(reader).count()
+        except DatabaseError as e:
+            print('failed: %s' % e)
+    return run
+
+
+if __name__ == '__main__':
+    setup_database()
+    reader = populate()
+    print('%d actions, %d follows' % (Action.objects.count(),
+                                      Follow.objects.count()))
+    measure('user: first page (follow lists)', page(Action.objects.user, reader))
+    measure('user_since: first page (EXISTS)',
+            page(Action.objects.user_since, reader))
+    measure('user: count (follow lists)', count(Action.objects.user, reader))
+    measure('user_since: count (EXISTS)',
+            count(Action.objects.user_since, reader))
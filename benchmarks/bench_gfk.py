@@ -0,0 +1,67 @@
+"""
+Benchmark of ``GFKQuerySet.fetch_generic_relations`` on 10k actions whose
+actors and targets spread over 5 content types.
+
+Compares lazily resolving every generic foreign key, the actstream GFK fetch
+(``USE_PREFETCH = False``) and Django's ``prefetch_related``.
+"""
+import itertools
+import random
+
+from base import setup_database, measure
+
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+
+from actstream import settings as actstream_settings
+from actstream.models import Action
+
+ACTIONS = 10000
+
+
+def populate():
+    Site.objects.get_or_create(pk=1, defaults={'domain': 'example.com',
+                                               'name': 'example.com'})
+    User.objects.bulk_create([User(username='user%d' % i) for i in range(200)])
+    Group.objects.bulk_create([Group(name='group%d' % i) for i in range(50)])
+    pools = [list(model.objects.all()) for model in
+             (User, Group, Permission, Site, ContentType)]
+    random.seed(0)
+    objects = list(itertools.chain(*pools))
+    Action.objects.bulk_create([
+        Action(actor_content_type=ContentType.objects.get_for_model(actor),
+               actor_object_id=actor.pk,
+               verb='benchmarked',
+               target_content_type=ContentType.objects.get_for_model(target),
+               target_object_id=target.pk)
+        for actor, target in ((random.choice(objects), random.choice(objects))
+                              for _ in range(ACTIONS))
+    ])
+
+
+def lazy():
+    [(a.actor, a.target) for a in Action.objects.all()]
+
+
+def gfk_fetch():
+    actstream_settings.USE_PREFETCH = False
+    [(a.actor, a.target) for a in
+     Action.objects.all().fetch_generic_relations()]
+
+
+def prefetch():
+    actstream_settings.USE_PREFETCH = True
+    [(a.actor, a.target) for a in
+     Action.objects.all().fetch_generic_relations()]
+
+
+if __name__ == '__main__':
+    setup_database()
+    populate()
+    print('%d actions, %d content types' % (
+        Action.objects.count(),
+        len(set(Action.objects.values_list('actor_content_type', flat=True)))))
+    measure('no fetch (lazy GFK access)', lazy, repeat=1)
+    measure('fetch_generic_relations (gfk fetch)', gfk_fetch)
+    measure('fetch_generic_relations (prefetch_related)', prefetch)
@@ -11,6 +11,8 @@ setup(name='django-activity-stream',
       author_email='justquick@gmail.com',
       url='http://github.com/justquick/django-activity-stream',
       packages=['actstream',
+                'actstream.management',
+                'actstream.management.commands',
                 'actstream.migrations',
                 'actstream.templatetags',
                 'actstream.templates'],